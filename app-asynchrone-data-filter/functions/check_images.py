@@ -2,7 +2,12 @@ import requests
 import logging
 import tqdm
 import concurrent.futures
+import threading
+import queue
 import os
+import numpy as np
+from functions.url_cache import get_url_cache
+from functions.classification_cache import content_hash
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -14,14 +19,24 @@ url_api = os.environ.get('URL_API')
 if url_api is None:
     raise EnvironmentError("The 'url_api' environment variable is not set.")
 
+# Number of images downloaded at the same time, of batches sent to the API at the same time,
+# of images by batch, and of images downloaded and waiting for their classification
+IMAGE_DOWNLOAD_WORKERS = int(os.environ.get('IMAGE_DOWNLOAD_WORKERS', 20))
+IMAGE_CLASSIFICATION_WORKERS = int(os.environ.get('IMAGE_CLASSIFICATION_WORKERS', 5))
+IMAGE_BATCH_SIZE = int(os.environ.get('IMAGE_BATCH_SIZE', 12))
+IMAGE_IN_FLIGHT = int(os.environ.get('IMAGE_IN_FLIGHT', 4 * IMAGE_BATCH_SIZE * IMAGE_CLASSIFICATION_WORKERS))
+
+# Result of an image the API didn't classify (error)
+NO_RESULT = object()
+
 # Request retrieving content of url
-def retrieve_url_content(url):    
+def retrieve_url_content(url, headers=None):    
     if not str(url).startswith("http"):
         # No url available
         return None
 
     try:
-        response = requests.get(url)
+        response = requests.get(url, headers=headers)
         return response
     
     except Exception as e:
@@ -81,88 +96,218 @@ def model_front_classification_batch(contents):
 
     return results
 
-def check_type_data_image(df, back_images, type_image):
+def classify_images(urls, desc="Classifying images", classification_cache=None, progress=None):
+    """
+    Front/Back classification of the images, as a pipeline:
+    - the images are downloaded by a pool of threads
+    - a batcher groups the contents by IMAGE_BATCH_SIZE
+    - the batches are sent to the API by a second pool of threads
+    The stages overlap, linked by bounded queues, and at most
+    IMAGE_IN_FLIGHT images are downloaded but not yet classified.
+    With a classification_cache, the images classified in a previous run are
+    neither downloaded nor classified again while their ETag / content is the same.
+    progress is called with the number of images classified (counters of a job).
+    Return the results in the order of urls, NO_RESULT when the API didn't answer
+    """
+    results = [NO_RESULT] * len(urls)
+    if not urls:
+        return results
+
+    contents_queue = queue.Queue(maxsize=2 * IMAGE_BATCH_SIZE * IMAGE_CLASSIFICATION_WORKERS)
+    in_flight = threading.BoundedSemaphore(IMAGE_IN_FLIGHT)
+    progress_bar = tqdm.tqdm(total=len(urls), desc=desc)
+    done = object()
+    cached = 0
+    errors = []
+
+    def use_cached_result(i, result):
+        nonlocal cached
+
+        results[i] = result
+        cached += 1
+        progress_bar.update(1)
+        if progress is not None:
+            progress(1)
+
+    def fetch(i, url):
+        """
+        Download the image, return the item to classify,
+        or None when the result of the cache is used
+        """
+        entry = classification_cache.get(url) if classification_cache is not None else None
+        headers = None
+
+        if entry is not None and entry["etag"]:
+            # ETag seen by a recent url check (within the ttl of the url cache), the image didn't change: no request
+            # An older check can't tell if the image was replaced, the conditional request is sent
+            url_cache = get_url_cache()
+            checked = url_cache.get(url)
+            if checked is not None and checked["etag"] == entry["etag"] and url_cache.is_fresh(checked):
+                return use_cached_result(i, entry["result"])
+
+            headers = {"If-None-Match": entry["etag"]}
+
+        response = retrieve_url_content(url, headers=headers)
+
+        if response is not None and entry is not None and response.status_code == 304:
+            return use_cached_result(i, entry["result"])
+
+        if response is None:
+            # The API needs one file by image, "None" when there is no content
+            return (i, "None", None)
+
+        metadata = None
+        if classification_cache is not None:
+            hash_value = content_hash(response.content)
+            result = classification_cache.get_by_hash(hash_value)
+            if result is not None:
+                # Same image under another url, or without ETag
+                classification_cache.set(url, result, response.headers.get("ETag"), hash_value)
+                return use_cached_result(i, result)
+
+            metadata = (url, response.headers.get("ETag"), hash_value)
+
+        return (i, response.content, metadata)
+
+    def download(i, url):
+        item = None
+        try:
+            item = fetch(i, url)
+        except Exception as e:
+            logger.error(f"Error retrieving content from URL {url}: {str(e)}")
+            if results[i] is NO_RESULT:
+                item = (i, "None", None)
+        finally:
+            # The permit of an image sent to the classification is released by classify
+            if item is None:
+                in_flight.release()
+
+        if item is not None:
+            contents_queue.put(item)
+
+    def classify(batch):
+        try:
+            try:
+                batch_results = model_front_classification_batch([content for _, content, _ in batch]) or []
+            except Exception as e:
+                logger.error(f"Error classifying a batch of images: {str(e)}")
+                batch_results = []
+
+            for (i, _, _), result in zip(batch, batch_results):
+                results[i] = result
+
+            # Only the answers of the model are kept, not the errors
+            if classification_cache is not None:
+                try:
+                    for (_, _, metadata), result in zip(batch, batch_results):
+                        if metadata is not None and result is not None:
+                            url, etag, hash_value = metadata
+                            classification_cache.set(url, result, etag, hash_value)
+                except Exception as e:
+                    logger.error(f"Error saving results in the classification cache: {str(e)}")
+
+        finally:
+            for _ in batch:
+                in_flight.release()
+
+            progress_bar.update(len(batch))
+            if progress is not None:
+                progress(len(batch))
+
+    def keep_error(future):
+        # The errors of the threads are raised at the end, not lost in their futures
+        if future.exception() is not None:
+            logger.error(f"Error in the image pipeline: {str(future.exception())}")
+            errors.append(future.exception())
+
+    def batcher(classify_executor):
+        # Groups the downloaded contents, a partial batch is sent at the end
+        batch = []
+        while True:
+            item = contents_queue.get()
+            if item is done:
+                break
+
+            batch.append(item)
+            if len(batch) == IMAGE_BATCH_SIZE:
+                classify_executor.submit(classify, batch).add_done_callback(keep_error)
+                batch = []
+
+        if batch:
+            classify_executor.submit(classify, batch).add_done_callback(keep_error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_CLASSIFICATION_WORKERS) as classify_executor:
+        batcher_thread = threading.Thread(target=batcher, args=(classify_executor,))
+        batcher_thread.start()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as download_executor:
+            for i, url in enumerate(urls):
+                # Waits while too many images are waiting for their classification
+                in_flight.acquire()
+                download_executor.submit(download, i, url).add_done_callback(keep_error)
+
+        contents_queue.put(done)
+        batcher_thread.join()
+
+    progress_bar.close()
+
+    if errors:
+        raise errors[0]
+
+    if classification_cache is not None:
+        logger.info(f"{cached} image(s) out of {len(urls)} answered by the classification cache")
 
-    if len(back_images) > 0:
-        num_concurrent_requests = 20 # Number of concurrent requests   
-        num_concurrent_workers = 5 # Number of concurrent workers 
-        batch_size = 12 # Number of images sent by batch 
-        chunk_size = 48 # Size to send batch   
+    return results
 
-        initial_df = df[df.index.isin(back_images)]
+def check_type_data_image(df, back_images, type_image, classification_cache=None, progress=None):
+
+    if len(back_images) > 0:
+        # Positions of the products to check in df, the results are aligned with them
+        candidate_positions = np.flatnonzero(df.index.isin(back_images))
+        initial_df = df.iloc[candidate_positions]
 
         # We retrieve the urls 
         urls_image = initial_df[type_image].to_list()
 
-        results_images = []
+        stage_progress = None
+        if progress is not None:
+            progress(type_image, 0, len(urls_image))
+            stage_progress = lambda count: progress(type_image, count)
 
-        # Split the contents into batches
-        if batch_size < len(urls_image):
-            for i in range(0, len(urls_image), chunk_size):
-                
-                # To show the progression every 10 
-                if (i) % (10*chunk_size) == 0:
-                    progress_percentage = ((i + 1) / len(urls_image)) * 100
-                    print(f"Progression: {progress_percentage:.2f}%")
+        results_images = classify_images(urls_image, desc=f"Processing images for {type_image}",
+                                         classification_cache=classification_cache, progress=stage_progress)
 
-                chunk_url_images = urls_image[i:i + chunk_size] if i + chunk_size < len(urls_image) + 1 else urls_image[i:]
+        # Results aligned with the candidates, the products without result are neither front nor back
+        results = np.empty(len(candidate_positions), dtype=object)
+        results[:] = results_images
 
-                # First, we retrieve the contents of the images
-                with concurrent.futures.ThreadPoolExecutor(max_workers=num_concurrent_requests) as executor:
-                    contents = list(executor.map(retrieve_url_content, chunk_url_images))
-                    # We clean that up
-                    if len(contents) > 1:
-                        contents = [content.content if content is not None else "None" for content in contents]
+        answered = np.array([result is not NO_RESULT for result in results_images], dtype=bool)
 
-                content_batches = [contents[idx:idx+batch_size] for idx in range(0, len(contents), batch_size)] if len(contents) > batch_size else [contents]
+        is_front = results == "1"
+        front_positions = candidate_positions[is_front]
+        back_positions = candidate_positions[answered & ~is_front]
 
-                #the content_batches to the API, that will return the result into the list
-                with concurrent.futures.ProcessPoolExecutor(max_workers=num_concurrent_workers) as executor:
-                    results_images.extend(executor.map(model_front_classification_batch, content_batches))
+        logger.info(f"Number of images corresponding to front: '{len(front_positions)}'")    
 
-            # At the end, we flatten the list
-            results_images = [num for sublist in results_images for num in sublist]
-
-        else:
-            # First, we retrieve the contents of the images
-            with concurrent.futures.ThreadPoolExecutor(max_workers=num_concurrent_requests) as executor:
-                contents = list(tqdm.tqdm(executor.map(retrieve_url_content, urls_image), total=len(urls_image),
-                                            desc=f"Retrieving contents for {type_image}"))
-                # We clean that up
-                if len(contents) > 1:
-                    contents = [content.content if content is not None else "None" for content in contents]
-
-            with concurrent.futures.ProcessPoolExecutor(max_workers=num_concurrent_workers) as executor:
-                results_images.extend(tqdm.tqdm(executor.map(model_front_classification, contents),
-                                                total=len(contents),
-                                                desc=f"Processing single images for {type_image}"))  # image in single
-        
-        # We retrieve the index of the images that need to be change
-        initial_df_index = initial_df.index.to_list()
-        index = [i for i, value in enumerate(results_images) if value == "1"]
-        front_images = [value for i, value in enumerate(initial_df_index) if i in index]
-
-        logger.info(f"Number of images corresponding to front: '{len(front_images)}'")    
-
-        if type_image != "image_1":
-            df.loc[df.index.isin(front_images), ["image_1", type_image]] = df.loc[df.index.isin(front_images), [type_image, "image_1"]].to_numpy()    
-
-        # We retrieve the index of the images that need to be change
-        index = [i for i, value in enumerate(results_images) if value != "1"]
-        back_images = [value for i, value in enumerate(initial_df_index) if i in index]
+        if type_image != "image_1" and len(front_positions):
+            # The front image becomes image_1
+            columns = df.columns.get_indexer(["image_1", type_image])
+            df.iloc[front_positions, columns] = df.iloc[front_positions, columns[::-1]].to_numpy()
 
         if type_image == "image_4":
-            logger.info(f"Number of product(s) with no proper images: '{len(back_images)}'")
+            logger.info(f"Number of product(s) with no proper images: '{len(back_positions)}'")
 
-            df.loc[df.index.isin(back_images), ["image_1", "image_2", "image_3", "image_4"]] = None
+            df.iloc[back_positions, df.columns.get_indexer(["image_1", "image_2", "image_3", "image_4"])] = None
 
-        return df, back_images
+        return df, df.index[back_positions].to_list()
     
     else:
         return df, []
 
 # Function checking images_1 in DataFrame of products 
-def check_data_image(df):
+# The classification_cache (ClassificationCache) avoids classifying the same images at each run
+# progress(stage, count, total) counts the images classified for each image column
+def check_data_image(df, classification_cache=None, progress=None):
 
     logger.info(f"[INFO] A total of {df.shape[0]} images will be processed...")
 
@@ -175,7 +320,7 @@ def check_data_image(df):
 
     for i, image_type in enumerate(image_types, start=1):
         logger.info(f"[INFO] Processing images {i}...")
-        df, back_images = check_type_data_image(df, back_images, image_type)
+        df, back_images = check_type_data_image(df, back_images, image_type, classification_cache, progress)
 
     logger.info("[INFO] Front/Back classification...Done")
     
@@ -1,11 +1,25 @@
+import os
+import asyncio
 import requests
-import concurrent.futures
+import httpx
 import logging
+from collections import defaultdict
+from urllib.parse import urlsplit
+import numpy as np
+from functions.url_cache import get_url_cache, REQUEST_TIMEOUT, BATCH_SIZE
+from functions.url_status import url_keys
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__) 
 
+# The requests of the url checks are not logged one by one
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Number of urls checked at the same time, in total and on the same host
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('URL_CHECK_CONCURRENCY', 100))
+MAX_REQUESTS_PER_HOST = int(os.environ.get('URL_CHECK_PER_HOST', 50))
+
 def get_image(code, number = 1):
     # Transform the code to produce the Open Food Facts image URL
     # number = the image we choose to retrieve
@@ -22,11 +36,26 @@ def get_image(code, number = 1):
 def generate_urls(df):
     """
     Generate urls for the products (image 1 to 4 at 400  pxl)
+    Same urls as get_image, built with string operations on the whole column:
+    the path of the product is computed once, then used for the 4 images
     Return the modified df
     """
+    codes = df["code"].astype(str)
+
+    # As str(code) in get_image, a missing code gives 'nan' / 'None'
+    missing = codes.isna()
+    if missing.any():
+        codes = codes.mask(missing, df["code"][missing].map(str))
+
+    # Codes longer than 8 digits: padded to 13 digits then split as xxx/xxx/xxx/xxxx
+    padded = codes.str.pad(13, side="left", fillchar="0")
+    split_path = padded.str[:3] + "/" + padded.str[3:6] + "/" + padded.str[6:9] + "/" + padded.str[9:]
+
+    path = split_path.where(codes.str.len() > 8, codes)
+    base_url = "https://images.openfoodfacts.org/images/products/" + path + "/"
 
     for i in range(1, 5):
-        df[f"image_{i}"] = df.apply(lambda x: get_image(str(x["code"]), number = f"{i}.400"), axis = 1)
+        df[f"image_{i}"] = base_url + f"{i}.400.jpg"
 
     return df
 
@@ -35,57 +64,166 @@ def check_url_image(url):
     """
     Check if the link of the image is correct
     Return none if not
+    The urls already checked are answered by the url cache, without request
     """
     
+    cached = get_url_cache().lookup(url)
+    if cached is not None:
+        return url if cached else None
+
     try:
-        response = requests.head(url) # We use head instead of get, we only need to check the link
+        response = requests.head(url, timeout=REQUEST_TIMEOUT) # We use head instead of get, we only need to check the link
+        get_url_cache().record_response(url, response)
         response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
         return url
     except requests.exceptions.RequestException:
         return None
     
-def check_image_urls_parallel(urls, checked_images, failed_img):
+async def check_url_image_async(client, url, host_limits):
     """
-    The check_image_urls_parallel function uses concurrent.futures.ThreadPoolExecutor 
-    to perform the checks concurrently.
+    Same as check_url_image, with the shared asynchronous client
+    The url cache is read and written by batches by the pipeline, not here
+    Return True if the link is correct, and the response (None if network error)
     """
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        #The map function is used to apply the check_url function to each URL in parallel.
-        results = executor.map(check_url_image, urls) # return a generator
-      
-    #The check_url_image function puts the results appropriate queue (checked_queue or failed_queue)
-    for result, url in zip(results, urls):
-        if result is not None:
-            checked_images.add(result)
-        else:
-            checked_images.add(url)
-            failed_img.add(url)
-
-def testing_urls_data(df, checked_images, failed_img):
-    total_rows = df.shape[0]
+
+    # Limit of concurrent requests on the same host
+    async with host_limits[urlsplit(url).netloc]:
+        try:
+            response = await client.head(url)
+        except httpx.HTTPError:
+            # Network error, not kept in the cache
+            return False, None
+
+    return response.status_code < 400, response
+
+def candidate_urls(df, status_index, stale_keys=None):
+    """
+    Generator of the urls to check, from the four images columns
+    The urls already checked (one lookup by column) and the duplicates are skipped,
+    except the stale ones (stale_keys, from url_keys): their check expired in the url cache
+    """
+    seen = set()
 
     for image in ["image_1", "image_2", "image_3", "image_4"]:
-        print(f"Processing: {total_rows} {image}")
-        
-        for idx in range(0, total_rows, 100):
-            print(f"{idx} urls processed")
-            # To show the progression every 1%
-
-            if (idx + 1) % (total_rows // 100) == 0:
-                progress_percentage = ((idx + 1) / total_rows) * 100
-                print(f"Progression: {progress_percentage:.2f}%")
+        urls = df[image][df[image].map(lambda x: isinstance(x, str))].to_numpy(dtype=object)
+        checked, _ = status_index.lookup(urls)
+
+        if stale_keys is not None and len(stale_keys):
+            checked &= ~np.isin(url_keys(urls), stale_keys)
+
+        for url in urls[~checked]:
+            if url not in seen:
+                seen.add(url)
+                yield url
+
+async def testing_urls_data_async(df, status_index, checkpoint=None, progress=None, stale_keys=None):
+    """
+    Check every url of the dataframe through one bounded pipeline:
+    a producer streams the urls in a queue, the workers check them with
+    one pooled client (keep-alive) and a limit of requests per host
+    The url cache is read and written by batches of BATCH_SIZE urls,
+    in a thread, the event loop doesn't wait on SQLite
+    The results are added to status_index (UrlStatusIndex), the new status
+    of the stale urls (stale_keys) replaces the previous one
+    With a checkpoint (UrlCheckpoint), the progress is saved at regular
+    intervals and when the checks fail
+    progress is called with the number of urls checked (counters of a job)
+    """
+    urls_queue = asyncio.Queue(maxsize=2 * MAX_CONCURRENT_REQUESTS)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(MAX_REQUESTS_PER_HOST))
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=MAX_CONCURRENT_REQUESTS)
+    url_cache = get_url_cache()
+    responses = []
+    processed = 0
+    failed = 0
+
+    async def put_batch(batch):
+        # The urls known by the cache go to the workers with their status, without request
+        known = await asyncio.to_thread(url_cache.lookup_many, batch)
+        for url in batch:
+            await urls_queue.put((url, known.get(url)))
+
+    async def producer():
+        batch = []
+        for url in candidate_urls(df, status_index, stale_keys):
+            batch.append(url)
+            if len(batch) == BATCH_SIZE:
+                await put_batch(batch)
+                batch = []
+
+        if batch:
+            await put_batch(batch)
+
+        # One signal to stop for each worker
+        for _ in range(MAX_CONCURRENT_REQUESTS):
+            await urls_queue.put(None)
+
+    async def save_responses():
+        nonlocal responses
+
+        batch, responses = responses, []
+        if batch:
+            await asyncio.to_thread(url_cache.record_responses, batch)
+
+    async def worker(client):
+        nonlocal processed, failed
+
+        while True:
+            item = await urls_queue.get()
+            if item is None:
+                return
+
+            url, valid = item
+            if valid is None:
+                valid, response = await check_url_image_async(client, url, host_limits)
+
+                if response is not None:
+                    responses.append((url, response))
+                    if len(responses) >= BATCH_SIZE:
+                        await save_responses()
+
+            record = status_index.add(url, not valid)
+            if not valid:
+                failed += 1
+
+            if progress is not None:
+                progress(1)
+
+            if checkpoint is not None:
+                checkpoint.record(record)
+                if checkpoint.due():
+                    # The upload runs in a thread, the other workers keep checking
+                    await asyncio.to_thread(checkpoint.write, checkpoint.snapshot())
+
+            processed += 1
+            # To show the progression
+            if processed % 10000 == 0:
+                print(f"{processed} urls processed")
+
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT) as client:
+            tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker(client)) for _ in range(MAX_CONCURRENT_REQUESTS)]
             try:
-                testing_img(df[idx:idx+100][image], checked_images, failed_img)
-            except:
-                testing_img(df[idx:total_rows][image], checked_images, failed_img)
-    return df
+                await asyncio.gather(*tasks)
+            finally:
+                # When one task fails, the others don't stay blocked on the queue
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        await save_responses()
 
-def testing_img(urls, checked_images, failed_img):
-    to_test = []
+    except BaseException:
+        # Last checkpoint when the checks fail or are cancelled,
+        # otherwise the next periodic checkpoint (next chunk) keeps the new urls
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
 
-    for i, url in enumerate(urls):
-        if url not in checked_images:
-            to_test.append(url)
+    print(f"{processed} urls processed, {failed} failed urls")
+
+    return df
 
-    check_image_urls_parallel(to_test, checked_images, failed_img)  
\ No newline at end of file
+def testing_urls_data(df, status_index, checkpoint=None, progress=None, stale_keys=None):
+    # Synchronous version, when not called from an event loop
+    return asyncio.run(testing_urls_data_async(df, status_index, checkpoint, progress, stale_keys))
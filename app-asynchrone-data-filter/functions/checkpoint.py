@@ -0,0 +1,109 @@
+import os
+import re
+import time
+import threading
+import logging
+from functions.path_functions import load_pickle_file, create_pickle_file, remove_local_file
+from functions.s3_functions import upload_file_to_s3, load_pickle_from_s3, delete_file_from_s3
+from functions.url_status import RecordBuffer
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Local folder of the checkpoints, and their folder in the S3 bucket
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', 'checkpoints')
+CHECKPOINT_S3_PREFIX = os.environ.get('CHECKPOINT_S3_PREFIX', 'files/checkpoints/')
+
+# Seconds between two checkpoints during the url checks
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 300))
+
+
+class UrlCheckpoint:
+    """
+        Progress of the url checks of one data file.
+        Only the records (url status index) of the urls checked during the job are kept,
+        written at regular intervals in the local folder and in the S3 bucket,
+        so a restarted job (new dyno, crash) starts again from the last checkpoint.
+        The checkpoint is removed once the results of the job are uploaded.
+    """
+
+    def __init__(self, data_file_S3, bucket_name=None, interval=CHECKPOINT_INTERVAL):
+        # files/cleaned_data.csv -> files_cleaned_data.csv.pkl
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", str(data_file_S3)) + ".pkl"
+
+        self.local_path = os.path.join(CHECKPOINT_DIR, name)
+        self.object_key = CHECKPOINT_S3_PREFIX + name
+        self.bucket_name = bucket_name
+        self.interval = interval
+
+        # uint64 records, 8 bytes by url checked
+        self.records = RecordBuffer()
+        self.last_saved = time.monotonic()
+
+        # A snapshot still uploading in a thread never overwrites a newer one
+        self._sequence = 0
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+            Load the last checkpoint, local first (same dyno) then from S3
+            Return the number of urls already checked, the records are in self.records.array()
+        """
+        state = None
+
+        if os.path.exists(self.local_path):
+            state = load_pickle_file(self.local_path)
+        elif self.bucket_name:
+            state = load_pickle_from_s3(self.bucket_name, self.object_key)
+
+        if isinstance(state, dict):
+            self.records.clear()
+            self.records.extend(state.get("records", ()))
+
+        return len(self.records)
+
+    def record(self, record):
+        self.records.append(record)
+
+    def due(self):
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def snapshot(self):
+        # Copy of the records, taken in the event loop while no worker adds urls
+        self.last_saved = time.monotonic()
+        self._sequence += 1
+        return {"records": self.records.array().copy(), "saved_at": time.time(),
+                "sequence": self._sequence}
+
+    def write(self, state):
+        """
+            Write a snapshot locally then upload it
+            Can run in a thread, the records are a copy
+        """
+        with self._lock:
+            if state["sequence"] < self._written:
+                return
+            self._written = state["sequence"]
+
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+
+            # Written next to the checkpoint then moved, a crash never leaves a partial file
+            temporary_path = f"{self.local_path}.tmp"
+            create_pickle_file(state, temporary_path)
+            os.replace(temporary_path, self.local_path)
+
+            if self.bucket_name:
+                upload_file_to_s3(self.local_path, self.bucket_name, self.object_key)
+
+        logger.info(f"Checkpoint saved: {len(state['records'])} urls checked")
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def clear(self):
+        # The job is done, the next one starts from the start
+        remove_local_file(self.local_path)
+        if self.bucket_name:
+            delete_file_from_s3(self.bucket_name, self.object_key)
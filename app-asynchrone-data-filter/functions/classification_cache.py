@@ -0,0 +1,84 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Version of the front/back model of the API, to change when the model changes:
+# the results of another version are not used
+MODEL_VERSION = os.environ.get('FRONT_MODEL_VERSION', 'front_back_mobilevnet2')
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class ClassificationCache:
+    """
+        Results of the front/back classification of the images, kept in a SQLite
+        file from one run to the next (downloaded from / uploaded to the S3 bucket).
+        A result is found by the url of the image and the model version,
+        and reused while the ETag of the image doesn't change. Without ETag,
+        an image with the same content hash is not classified again.
+    """
+
+    def __init__(self, path, model_version=MODEL_VERSION):
+        self.path = path
+        self.model_version = model_version
+
+        # One connection shared by the threads of the pipeline, the writes are few
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS classification (
+                    url TEXT NOT NULL,
+                    model_version TEXT NOT NULL,
+                    etag TEXT,
+                    content_hash TEXT,
+                    result TEXT NOT NULL,
+                    classified_at REAL NOT NULL,
+                    PRIMARY KEY (url, model_version)
+                )
+            """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS classification_hash ON classification (content_hash, model_version)"
+            )
+
+    def get(self, url):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, content_hash, result FROM classification WHERE url = ? AND model_version = ?",
+                (url, self.model_version),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {"etag": row[0], "content_hash": row[1], "result": row[2]}
+
+    def get_by_hash(self, hash_value):
+        # Result of an image with the same content, whatever its url
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result FROM classification WHERE content_hash = ? AND model_version = ? LIMIT 1",
+                (hash_value, self.model_version),
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def set(self, url, result, etag=None, hash_value=None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO classification (url, model_version, etag, content_hash, result, classified_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, self.model_version, etag, hash_value, str(result), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
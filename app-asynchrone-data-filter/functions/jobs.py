@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import asyncio
+import threading
+import logging
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of jobs running at the same time, the others wait in the queue
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', 2))
+
+# Folder of the scratch directories of the jobs
+JOBS_DIR = os.environ.get('JOBS_DIR', 'jobs')
+
+# Seconds between two writes of the progress of a stage in the job table
+PROGRESS_INTERVAL = 1.0
+
+
+class JobStore:
+    """
+        Table of the jobs in a SQLite file: parameters, status, error,
+        and the progress counters of each stage (as json)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+
+    def create(self, job_type, params):
+        job_id = uuid.uuid4().hex
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO jobs (id, type, params, status, progress, created_at) VALUES (?, ?, ?, 'queued', '{}', ?)",
+                (job_id, job_type, json.dumps(params), time.time()),
+            )
+
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, type, params, status, progress, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {"id": row[0], "type": row[1], "params": json.loads(row[2]), "status": row[3],
+                "progress": json.loads(row[4]), "error": row[5],
+                "created_at": row[6], "started_at": row[7], "finished_at": row[8]}
+
+    def unfinished(self):
+        # Jobs queued or running when the process stopped
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def set_status(self, job_id, status, error=None):
+        column = {"running": "started_at", "done": "finished_at", "failed": "finished_at"}.get(status)
+
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE jobs SET status = ?, error = ? WHERE id = ?", (status, error, job_id))
+            if column:
+                self._connection.execute(f"UPDATE jobs SET {column} = ? WHERE id = ?", (time.time(), job_id))
+
+    def set_progress(self, job_id, progress):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+
+class Job:
+    """
+        Context given to the function of a job: its id, its parameters,
+        its scratch directory, and the progress counters of its stages
+    """
+
+    def __init__(self, job_id, params, store):
+        self.id = job_id
+        self.params = params
+        self.store = store
+        self.scratch_dir = os.path.join(JOBS_DIR, job_id)
+
+        self._progress = {}
+        self._lock = threading.Lock()
+        self._last_write = 0
+
+    def path(self, name):
+        # Path of a file of the job, two jobs never share their files
+        # The directory is created here, the job can run without the runner
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        return os.path.join(self.scratch_dir, name)
+
+    def advance(self, stage, count=1, total=None):
+        """
+            Add count to the counter of a stage (can be called from any thread),
+            the counters are written in the job table at most every PROGRESS_INTERVAL seconds
+        """
+        now = time.time()
+
+        with self._lock:
+            counters = self._progress.setdefault(stage, {"done": 0, "total": None, "started_at": now})
+            counters["done"] += count
+            if total is not None:
+                counters["total"] = total
+            counters["updated_at"] = now
+
+            # Throughput of the stage, in items by second
+            elapsed = now - counters["started_at"]
+            counters["per_second"] = round(counters["done"] / elapsed, 2) if elapsed > 0 else None
+
+            if now - self._last_write < PROGRESS_INTERVAL and counters["done"] != counters["total"]:
+                return
+            self._last_write = now
+            progress = json.loads(json.dumps(self._progress))
+
+        self.store.set_progress(self.id, progress)
+
+    def flush(self):
+        with self._lock:
+            progress = json.loads(json.dumps(self._progress))
+        self.store.set_progress(self.id, progress)
+
+
+class JobRunner:
+    """
+        Runs the jobs in the event loop of the app, at most max_concurrency at the same time.
+        A job function is an async function taking the Job, registered by its type.
+        The jobs not finished when the app stopped are run again at startup
+        (the url checks start again from their checkpoint).
+    """
+
+    def __init__(self, store, max_concurrency=MAX_CONCURRENT_JOBS):
+        self.store = store
+        self.job_types = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = {}
+
+    def register(self, job_type, function):
+        self.job_types[job_type] = function
+
+    def submit(self, job_type, params):
+        if job_type not in self.job_types:
+            raise ValueError(f"Unknown job type '{job_type}'")
+
+        job_id = self.store.create(job_type, params)
+        self._start(job_id, job_type, params)
+
+        return job_id
+
+    def resume(self):
+        for job_id in self.store.unfinished():
+            job = self.store.get(job_id)
+            if job["type"] in self.job_types:
+                logger.info(f"Resuming job '{job_id}' ({job['type']})")
+                self.store.set_status(job_id, "queued")
+                self._start(job_id, job["type"], job["params"])
+
+    def _start(self, job_id, job_type, params):
+        task = asyncio.get_running_loop().create_task(self._run(job_id, job_type, params))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, job_id, job_type, params):
+        async with self._semaphore:
+            job = Job(job_id, params, self.store)
+            os.makedirs(job.scratch_dir, exist_ok=True)
+            self.store.set_status(job_id, "running")
+
+            try:
+                await self.job_types[job_type](job)
+                job.flush()
+                self.store.set_status(job_id, "done")
+                logger.info(f"Job '{job_id}' done")
+
+            except Exception as e:
+                job.flush()
+                self.store.set_status(job_id, "failed", str(e))
+                logger.error(f"Job '{job_id}' failed: {str(e)}")
+
+            finally:
+                shutil.rmtree(job.scratch_dir, ignore_errors=True)
@@ -1,33 +1,77 @@
 import boto3
 import logging
 import io
+import os
+import threading
+import concurrent.futures
 import pandas as pd
 import pickle
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)  
 
+# Number of threads of a multipart transfer, and of files transferred at the same time
+S3_TRANSFER_CONCURRENCY = int(os.environ.get('S3_TRANSFER_CONCURRENCY', 10))
+S3_CONCURRENT_FILES = int(os.environ.get('S3_CONCURRENT_FILES', 4))
+
+# Multipart transfers above 16MB, by parts of 16MB sent by several threads
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
+    use_threads=True,
+)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """
+    Client shared by all the transfers (boto3 clients are thread-safe),
+    created at the first use, its connection pool covers the concurrent transfers
+    """
+    global _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config=Config(
+                max_pool_connections=S3_TRANSFER_CONCURRENCY * S3_CONCURRENT_FILES,
+                retries={'max_attempts': 5, 'mode': 'standard'},
+            ))
+
+    return _s3_client
+
+def reset_s3_client():
+    # The next transfer creates a new client (new credentials, tests with a mocked S3)
+    global _s3_client
+
+    with _s3_client_lock:
+        _s3_client = None
+
 # Function to load a file from S3
 def download_file_from_s3(bucket_name, object_key, local_file_path):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     try:
         # Download object in local from bucket
-        s3.download_file(bucket_name, object_key, local_file_path)
+        s3.download_file(bucket_name, object_key, local_file_path, Config=TRANSFER_CONFIG)
         logger.info(f"Downloaded file '{object_key}' to '{local_file_path}'")
     
     except Exception as e:
         logger.error(f"Error downloading file '{object_key}': {str(e)}")
 
-# Function to upload a file to S3
+# Function to upload a file to S3, return True if the file was uploaded
 def upload_file_to_s3(local_file_path, bucket_name, object_key):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     try:
-        # Download object in local from bucket
-        s3.upload_file(local_file_path, bucket_name, object_key)
+        # Upload the local file to the bucket
+        s3.upload_file(local_file_path, bucket_name, object_key, Config=TRANSFER_CONFIG)
         logger.info(f"Uploading file '{local_file_path}' to '{object_key}'")
+        return True
     
     except FileNotFoundError:
         logger.error(f"File not found: '{local_file_path}'")
@@ -35,9 +79,56 @@ def upload_file_to_s3(local_file_path, bucket_name, object_key):
     except Exception as e:
         logger.error(f"Error uploading file '{object_key}': {str(e)}")
 
+    return False
+
+# Function to upload a buffer (bytes, file-like object, stream) to S3, without local file
+# Return True if the buffer was uploaded
+def upload_fileobj_to_s3(data, bucket_name, object_key):
+    s3 = get_s3_client()
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+
+    try:
+        s3.upload_fileobj(data, bucket_name, object_key, Config=TRANSFER_CONFIG)
+        logger.info(f"Uploading buffer to '{object_key}'")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error uploading file '{object_key}': {str(e)}")
+
+    return False
+
+# Function to upload several files to S3 at the same time
+# uploads: list of (source, object_key), source is a local path or a buffer
+# Return True if all the files were uploaded
+def upload_files_to_s3(uploads, bucket_name):
+    def upload(source, object_key):
+        if isinstance(source, (str, os.PathLike)):
+            return upload_file_to_s3(source, bucket_name, object_key)
+        else:
+            return upload_fileobj_to_s3(source, bucket_name, object_key)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_CONCURRENT_FILES) as executor:
+        futures = [executor.submit(upload, source, object_key) for source, object_key in uploads]
+        return all([future.result() for future in futures])
+
+# Function to delete a file from S3
+def delete_file_from_s3(bucket_name, object_key):
+    s3 = get_s3_client()
+
+    try:
+        s3.delete_object(Bucket=bucket_name, Key=object_key)
+        logger.info(f"Deleting file '{object_key}'")
+
+    except Exception as e:
+        logger.error(f"Error deleting file '{object_key}': {str(e)}")
+
 # Function to load a csv from s3 
 def load_csv_from_s3(bucket_name, object_key, sep=','):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     try:
         response = s3.get_object(Bucket=bucket_name, Key=object_key)
@@ -47,9 +138,18 @@ def load_csv_from_s3(bucket_name, object_key, sep=','):
         logger.error(f"Error uploading csv file '{object_key}': {str(e)}")
         return None
 
+# Function to read a csv from s3 by chunks of rows, the object is streamed
+# The columns are read as text: the types inferred would change from one chunk to the next
+# (a code '00012345' read as 12345 in a chunk without other text codes)
+def iter_csv_chunks_from_s3(bucket_name, object_key, sep=',', chunksize=50000):
+    s3 = get_s3_client()
+
+    response = s3.get_object(Bucket=bucket_name, Key=object_key)
+    return pd.read_csv(response['Body'], sep=sep, chunksize=chunksize, dtype=str)
+
 # Function to load a pickle from s3
 def load_pickle_from_s3(bucket_name, object_key):
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
 
     try:
         response = s3.get_object(Bucket=bucket_name, Key=object_key)
@@ -57,4 +157,72 @@ def load_pickle_from_s3(bucket_name, object_key):
     
     except Exception as e:
         logger.error(f"Error uploading csv file '{object_key}': {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+
+class S3MultipartWriter:
+    """
+        Write a file to S3 while it is produced, with a multipart upload.
+        The data is kept in memory until a part is complete (5MB minimum for S3),
+        so the file is never entirely in memory or on the disk.
+        Used as a context manager, the upload is aborted if an error happens.
+    """
+
+    def __init__(self, bucket_name, object_key, part_size=8 * 1024 * 1024):
+        self.s3 = get_s3_client()
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.upload_id = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.object_key)
+            self.upload_id = response['UploadId']
+
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        if self.upload_id is None:
+            # Smaller than a part, one request is enough
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.object_key, Body=self.buffer.getvalue())
+        else:
+            if self.buffer.tell():
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+        logger.info(f"Uploading file to '{self.object_key}' ({len(self.parts)} parts)")
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.error(f"Error aborting upload of '{self.object_key}': {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
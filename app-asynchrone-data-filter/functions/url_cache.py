@@ -0,0 +1,218 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+import logging
+import requests
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Timeout of the HEAD requests, in seconds
+REQUEST_TIMEOUT = 10
+
+# Urls read or written by one query of the batch methods
+BATCH_SIZE = 500
+
+# File of the cache, it can be shared with the app, and time before an url is checked again
+URL_CACHE_PATH = os.environ.get('URL_CACHE_PATH', 'url_cache.sqlite3')
+URL_CACHE_TTL = float(os.environ.get('URL_CACHE_TTL', 30 * 24 * 3600))
+
+
+class UrlCache:
+    """
+        Validity of the image urls, kept in a SQLite file that several processes
+        (the worker, the Dash app) can share.
+        For each url we keep the result of the last check, its time, and the
+        ETag / Last-Modified headers used to revalidate it with a conditional request.
+        A url older than the ttl is still answered from the cache, and revalidated
+        in the background, so a request never waits on a url already checked.
+    """
+
+    def __init__(self, path, ttl, revalidate=True):
+        self.path = path
+        self.ttl = ttl
+
+        self._local = threading.local()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=10000)
+
+        connection = self._connection()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS url_status (
+                    url TEXT PRIMARY KEY,
+                    ok INTEGER NOT NULL,
+                    status_code INTEGER,
+                    checked_at REAL NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS url_status_checked_at ON url_status (checked_at)")
+
+        if revalidate:
+            threading.Thread(target=self._revalidation_worker, daemon=True).start()
+
+    def _connection(self):
+        # One connection by thread, sqlite3 connections can't be shared
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # Readers don't block the writer
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, url):
+        row = self._connection().execute(
+            "SELECT ok, status_code, checked_at, etag, last_modified FROM url_status WHERE url = ?", (url,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return {"ok": bool(row[0]), "status_code": row[1], "checked_at": row[2], "etag": row[3], "last_modified": row[4]}
+
+    def set(self, url, ok, status_code=None, etag=None, last_modified=None):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO url_status (url, ok, status_code, checked_at, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, int(ok), status_code, time.time(), etag, last_modified),
+            )
+
+    def is_fresh(self, entry):
+        return time.time() - entry["checked_at"] <= self.ttl
+
+    def lookup(self, url):
+        """
+            Return True / False if the url is known, None otherwise.
+            A stale url is returned as well, and queued for revalidation
+        """
+        entry = self.get(url)
+        if entry is None:
+            return None
+
+        if not self.is_fresh(entry):
+            self.revalidate_later(url)
+
+        return entry["ok"]
+
+    def lookup_many(self, urls):
+        """
+            Status of a list of urls, one query by BATCH_SIZE urls
+            Return a dict url -> True / False of the urls known and fresh,
+            the stale ones are checked again by the caller
+        """
+        known = {}
+        connection = self._connection()
+        checked_after = time.time() - self.ttl
+
+        for start in range(0, len(urls), BATCH_SIZE):
+            batch = list(urls[start:start + BATCH_SIZE])
+            rows = connection.execute(
+                f"SELECT url, ok FROM url_status WHERE checked_at >= ? AND url IN ({', '.join('?' * len(batch))})",
+                [checked_after] + batch,
+            ).fetchall()
+
+            known.update((url, bool(ok)) for url, ok in rows)
+
+        return known
+
+    def stale_urls(self):
+        # Urls checked before the ttl, their status has to be checked again
+        rows = self._connection().execute(
+            "SELECT url FROM url_status WHERE checked_at < ?", (time.time() - self.ttl,)
+        ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def record_responses(self, responses):
+        # Same as record_response for a list of (url, response), in one transaction
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO url_status (url, ok, status_code, checked_at, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)",
+                [(url, int(response.status_code < 400), response.status_code, now,
+                  response.headers.get("ETag"), response.headers.get("Last-Modified")) for url, response in responses],
+            )
+
+    def record_response(self, url, response):
+        # Keep the result of a HEAD request (requests or httpx) and the headers to revalidate it
+        self.set(url, response.status_code < 400, response.status_code,
+                 response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    def revalidate_later(self, url):
+        with self._pending_lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+
+        try:
+            self._queue.put_nowait(url)
+        except queue.Full:
+            with self._pending_lock:
+                self._pending.discard(url)
+
+    def revalidate(self, url):
+        # Conditional request, the server answers 304 if the image didn't change
+        entry = self.get(url) or {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = requests.head(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            # Network error, we keep the previous state
+            logger.warning(f"Error revalidating url {url}: {str(e)}")
+            return
+
+        if response.status_code == 304:
+            self.set(url, entry.get("ok", True), entry.get("status_code"), entry.get("etag"), entry.get("last_modified"))
+        else:
+            self.record_response(url, response)
+
+    def backup(self, path):
+        # Consistent copy of the cache (with the pages of the WAL), to upload it
+        destination = sqlite3.connect(path)
+        try:
+            self._connection().backup(destination)
+        finally:
+            destination.close()
+
+    def _revalidation_worker(self):
+        while True:
+            url = self._queue.get()
+            try:
+                self.revalidate(url)
+            except Exception as e:
+                logger.error(f"Error revalidating url {url}: {str(e)}")
+            finally:
+                with self._pending_lock:
+                    self._pending.discard(url)
+
+
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+def get_url_cache():
+    """
+    Cache shared by the checks of the worker, created at the first use:
+    importing the module neither creates the file nor starts the revalidation thread
+    """
+    global _url_cache
+
+    with _url_cache_lock:
+        if _url_cache is None:
+            _url_cache = UrlCache(URL_CACHE_PATH, ttl=URL_CACHE_TTL)
+
+    return _url_cache
@@ -0,0 +1,226 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Key of the hash of the urls, it must never change or the stored keys are lost
+HASH_KEY = "0123456789123456"
+
+# Lowest bit of a record: 1 if the url failed
+FAILED_BIT = np.uint64(1)
+KEY_MASK = ~FAILED_BIT
+
+# Number of records in the log above which it is merged in the sorted file
+COMPACT_THRESHOLD = int(os.environ.get('URL_STATUS_COMPACT_THRESHOLD', 1000000))
+
+def url_keys(urls):
+    """
+    Key of each url, on 63 bits (the last bit is the status)
+    The url only depends on the code of the product and the number of the image,
+    so it identifies both in 8 bytes instead of the ~100 bytes of the string
+    """
+    urls = np.asarray(urls, dtype=object)
+    return pd.util.hash_array(urls, hash_key=HASH_KEY, categorize=False) & KEY_MASK
+
+def encode_records(urls, failed):
+    # Record = key of the url + status bit
+    return url_keys(urls) | np.asarray(failed, dtype=bool).astype(np.uint64)
+
+
+class RecordBuffer:
+    """
+    Growable array of uint64 records, 8 bytes by record instead of the
+    ~70-100 bytes of a Python int in a list or a dict
+    """
+
+    def __init__(self, capacity=1024):
+        self._data = np.empty(capacity, dtype=np.uint64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, records):
+        records = np.asarray(records, dtype=np.uint64)
+
+        if self._size + len(records) > len(self._data):
+            # The capacity doubles, an append is amortized O(1)
+            data = np.empty(max(2 * len(self._data), self._size + len(records)), dtype=np.uint64)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+        self._data[self._size:self._size + len(records)] = records
+        self._size += len(records)
+
+    def append(self, record):
+        self.extend([record])
+
+    def array(self):
+        # View of the records, not a copy
+        return self._data[:self._size]
+
+    def clear(self):
+        self._size = 0
+
+
+def latest_records(records):
+    """
+    Sorted records keeping only the last record of each key (the most recent status)
+    """
+    if not len(records):
+        return np.empty(0, dtype=np.uint64)
+
+    # np.unique gives the first position of each key, on the reversed records it is the last one
+    reversed_records = records[::-1]
+    _, positions = np.unique(reversed_records & KEY_MASK, return_index=True)
+    return reversed_records[positions]
+
+
+class UrlStatusIndex:
+    """
+    Status of the urls already checked, replacing the pickled sets of urls.
+    - a sorted array of uint64 records (key + status bit) in a .npy file,
+      memory-mapped, a lookup is a binary search
+    - an append-only log of the new records (a RecordBuffer), written to a file
+      by batches, the sorted file is never rewritten for a new url.
+      The log is merged in the sorted file by compact()
+    A url present is checked, its status bit tells if it failed.
+    """
+
+    # Records written to the log file at once
+    LOG_FLUSH_SIZE = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = f"{path}.log"
+
+        if os.path.exists(path):
+            self.records = np.load(path, mmap_mode="r")
+        else:
+            self.records = np.empty(0, dtype=np.uint64)
+
+        # Records of the log in the order they were added, the last one of a key wins
+        self.log = RecordBuffer()
+        if os.path.exists(self.log_path):
+            self.log.extend(np.fromfile(self.log_path, dtype=np.uint64))
+        self._flushed = len(self.log)
+
+        # Sorted records of the log used by lookup, computed again when the log changed
+        self._latest_log = None
+
+        self._log_file = open(self.log_path, "ab")
+
+    def __len__(self):
+        return len(self.records) + len(self.latest_log())
+
+    def latest_log(self):
+        if self._latest_log is None:
+            self._latest_log = latest_records(self.log.array())
+        return self._latest_log
+
+    @staticmethod
+    def _search(sorted_records, keys):
+        # The status bit is the lowest one, the record of a key is the first one >= key
+        if not len(sorted_records):
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(sorted_records, keys), len(sorted_records) - 1)
+        found = sorted_records[positions]
+
+        checked = (found & KEY_MASK) == keys
+        failed = checked & ((found & FAILED_BIT) == FAILED_BIT)
+        return checked, failed
+
+    def lookup(self, urls):
+        """
+        Return two boolean arrays: the urls already checked, and the ones that failed
+        """
+        keys = url_keys(urls)
+
+        checked, failed = self._search(self.records, keys)
+
+        # The log is more recent than the sorted file
+        if len(self.log):
+            log_checked, log_failed = self._search(self.latest_log(), keys)
+            failed = np.where(log_checked, log_failed, failed)
+            checked = checked | log_checked
+
+        return checked, failed
+
+    def add_records(self, records):
+        """
+        Append records (from encode_records) to the log
+        """
+        records = np.asarray(records, dtype=np.uint64)
+        if not len(records):
+            return
+
+        self.log.extend(records)
+        self._latest_log = None
+
+        if len(self.log) - self._flushed >= self.LOG_FLUSH_SIZE:
+            self.flush()
+
+        if len(self.log) >= COMPACT_THRESHOLD:
+            self.compact()
+
+    def add(self, url, failed):
+        # Add one url, return its record
+        records = encode_records([url], [failed])
+        self.add_records(records)
+        return int(records[0])
+
+    def flush(self):
+        # Write the records of the log not yet in the log file
+        self._log_file.write(self.log.array()[self._flushed:].tobytes())
+        self._log_file.flush()
+        self._flushed = len(self.log)
+
+    def compact(self):
+        """
+        Merge the log in the sorted file, written next to it then moved
+        """
+        if not len(self.log):
+            return
+
+        log_records = self.latest_log()
+        log_keys = log_records & KEY_MASK
+
+        # The records of the file replaced by the log are dropped
+        records = np.asarray(self.records)
+        keep = ~np.isin(records & KEY_MASK, log_keys)
+        merged = np.sort(np.concatenate([records[keep], log_records]))
+
+        temporary_path = f"{self.path}.tmp.npy"
+        np.save(temporary_path, merged)
+        os.replace(temporary_path, self.path)
+
+        self.records = np.load(self.path, mmap_mode="r")
+        self.log.clear()
+        self._flushed = 0
+        self._latest_log = None
+
+        self._log_file.close()
+        self._log_file = open(self.log_path, "wb")
+
+        logger.info(f"Url status index compacted: {len(merged)} urls")
+
+    def close(self):
+        self.flush()
+        self._log_file.close()
+
+    @classmethod
+    def from_sets(cls, path, checked_images, failed_images):
+        """
+        Build the index from the former pickled sets of urls
+        """
+        urls = list(checked_images | failed_images)
+        records = np.sort(encode_records(urls, [url in failed_images for url in urls]))
+
+        np.save(path, records)
+
+        return cls(path)
@@ -1,12 +1,19 @@
-from fastapi import FastAPI, Form, BackgroundTasks
+from fastapi import FastAPI, Form, HTTPException
 import pandas as pd
 import os
+import io
 import gc
+import asyncio
 import logging
 from functions.check_images import check_data_image
-from functions.check_urls import testing_urls_data, generate_urls
-from functions.path_functions import remove_local_file, create_pickle_file
-from functions.s3_functions import upload_file_to_s3, load_csv_from_s3, load_pickle_from_s3
+from functions.check_urls import testing_urls_data_async, generate_urls
+from functions.checkpoint import UrlCheckpoint
+from functions.url_status import UrlStatusIndex, url_keys
+from functions.classification_cache import ClassificationCache
+from functions.url_cache import get_url_cache, URL_CACHE_PATH
+from functions.jobs import JobStore, JobRunner
+from functions.path_functions import remove_local_file
+from functions.s3_functions import upload_files_to_s3, download_file_from_s3, load_csv_from_s3, load_pickle_from_s3, iter_csv_chunks_from_s3, S3MultipartWriter
 
 app = FastAPI()
 
@@ -20,156 +27,288 @@ bucket_name = os.environ.get('S3_BUCKET_NAME')
 if bucket_name is None:
     raise EnvironmentError("The 'S3_BUCKET_NAME' environment variable is not set.")
 
+# Number of rows of the data processed at once by the url checks
+URL_CHUNK_SIZE = int(os.environ.get('URL_CHUNK_SIZE', 50000))
+
+# Jobs of the app, at most MAX_CONCURRENT_JOBS run at the same time
+job_store = JobStore(os.environ.get('JOBS_DB_PATH', 'jobs.sqlite3'))
+job_runner = JobRunner(job_store)
+
+# The url status index and the classification cache are shared by the jobs,
+# they are updated by one job at a time
+url_status_lock = asyncio.Lock()
+classification_cache_lock = asyncio.Lock()
+
 @app.get("/")
 def home():
     return {"health_check": "OK"}
 
 
-async def process_urls(
-    data_file_S3: str = Form(None),
-    data_file_S3_post_urls_clean_up : str = Form(None)):
+async def process_urls(data_file_S3, data_file_S3_post_urls_clean_up, job):
+    """
+    The data is streamed by chunks of rows: each chunk is read from S3,
+    its urls are generated and checked, then it is written to the new file
+    with a multipart upload, the memory used doesn't depend on the size of the file
+    The files are in the scratch directory of the job, the progress in its counters
+    """
+    async with url_status_lock:
+        await check_urls_file(data_file_S3, data_file_S3_post_urls_clean_up, job)
+
+def build_status_index(local_status_path, checked_images_S3, failed_images_S3):
+    # Url status index built from the former pickled sets of urls
+    checked_images = load_pickle_from_s3(bucket_name, checked_images_S3) or set()
+    failed_images = load_pickle_from_s3(bucket_name, failed_images_S3) or set()
+    return UrlStatusIndex.from_sets(local_status_path, checked_images, failed_images)
+
+def write_csv_chunk(writer, df, header):
+    # The header is only written with the first chunk
+    writer.write(df.to_csv(sep = "\t", index=None, header=header))
+
+def csv_buffer(df):
+    # The csv of the data in memory, ready to be uploaded
+    data_buffer = io.BytesIO()
+    df.to_csv(data_buffer, sep = "\t", index=None)
+    data_buffer.seek(0)
+    return data_buffer
+
+async def check_urls_file(data_file_S3, data_file_S3_post_urls_clean_up, job):
 
     # S3 bucket from the project and files
+    url_status_S3 = 'files/url_status.npy'
+    url_cache_S3 = 'files/url_cache.sqlite3'
     checked_images_S3 = 'files/checked_images.pkl'
     failed_images_S3 = 'files/failed_images.pkl'
 
-    # Local file paths to save the downloaded files
-    local_data_path = 'local_data.csv'
-    local_checked_path = 'checked_images.pkl'
-    local_failed_path = 'failed_images.pkl'
+    # Local file path to save the downloaded file
+    local_status_path = job.path('url_status.npy')
 
     print("[INFO] Loading files from S3...")
 
-    df = load_csv_from_s3(bucket_name, data_file_S3, sep='\t')
-    checked_images = load_pickle_from_s3(bucket_name, checked_images_S3)
-    failed_images = load_pickle_from_s3(bucket_name, failed_images_S3)
+    # The transfers and the file operations are blocking, they run in a thread:
+    # the app keeps answering (status of the jobs) during the job
+    chunks = await asyncio.to_thread(iter_csv_chunks_from_s3, bucket_name, data_file_S3, sep='\t', chunksize=URL_CHUNK_SIZE)
+
+    await asyncio.to_thread(download_file_from_s3, bucket_name, url_status_S3, local_status_path)
+
+    # The url cache of the previous runs, kept in the bucket between the restarts of the dyno
+    if not os.path.exists(URL_CACHE_PATH):
+        await asyncio.to_thread(download_file_from_s3, bucket_name, url_cache_S3, URL_CACHE_PATH)
+    if os.path.exists(local_status_path):
+        status_index = await asyncio.to_thread(UrlStatusIndex, local_status_path)
+    else:
+        # First run with the index, built from the former pickled sets of urls
+        print("[INFO] Building the url status index from the pickle files...")
+        status_index = await asyncio.to_thread(build_status_index, local_status_path, checked_images_S3, failed_images_S3)
 
-    print("[INFO] Generating urls...")
-    
-    df = generate_urls(df)
+    # The urls checked before the ttl of the url cache are checked again, their new status replaces the one of the index
+    stale_urls = await asyncio.to_thread(get_url_cache().stale_urls)
+    stale_keys = url_keys(stale_urls) if stale_urls else None
+    if stale_urls:
+        print(f"[INFO] {len(stale_urls)} urls checked before the ttl of the url cache will be checked again...")
+    del stale_urls
 
-    print("[INFO] Checking urls...")
+    # Progress of a previous run of the job on the same file (restart, crash)
+    checkpoint = UrlCheckpoint(data_file_S3, bucket_name)
+    resumed = await asyncio.to_thread(checkpoint.load)
+    if resumed:
+        print(f"[INFO] Resuming from checkpoint, {resumed} urls already checked will be skipped...")
+        status_index.add_records(checkpoint.records.array())
 
-    # Calling function to check urls in dataframe
-    df = testing_urls_data(df, checked_images, failed_images)
-    
-    print("[INFO] Eliminating failed urls from data...")
+    with S3MultipartWriter(bucket_name, data_file_S3_post_urls_clean_up) as writer:
+        chunk_number = 0
 
-    # Eliminating failed urls
-    for images in ["image_1", "image_2", "image_3", "image_4"]:
-        df[images] = df[images].apply(lambda x: None if x in failed_images else x)
+        while True:
+            # Reading and uploading are blocking, they run in a thread
+            df = await asyncio.to_thread(next, chunks, None)
+            if df is None:
+                break
 
-    print("[INFO] Creating files in local...")
+            chunk_number += 1
+            print(f"[INFO] Chunk {chunk_number}: generating urls of {df.shape[0]} products...")
+            job.advance("rows", df.shape[0])
 
-    # Create file in path
-    df.to_csv(local_data_path, sep = "\t", index=None)
-    create_pickle_file(checked_images, local_checked_path)
-    create_pickle_file(failed_images, local_failed_path)
+            df = generate_urls(df)
+
+            print(f"[INFO] Chunk {chunk_number}: checking urls...")
+
+            # Calling function to check urls in dataframe
+            df = await testing_urls_data_async(df, status_index, checkpoint,
+                                               progress=lambda count: job.advance("urls", count), stale_keys=stale_keys)
+
+            # Eliminating failed urls
+            for images in ["image_1", "image_2", "image_3", "image_4"]:
+                _, failed = status_index.lookup(df[images].to_numpy(dtype=object))
+                df[images] = df[images].mask(failed)
+
+            await asyncio.to_thread(write_csv_chunk, writer, df, chunk_number == 1)
+
+            del df
 
     print("[INFO] Uploading files to S3...")
 
-    # We upload the new files
-    upload_file_to_s3(local_data_path, bucket_name, data_file_S3_post_urls_clean_up)
-    upload_file_to_s3(local_checked_path, bucket_name, checked_images_S3)
-    upload_file_to_s3(local_failed_path, bucket_name, failed_images_S3)
+    # The new urls of the log are merged in the index file
+    await asyncio.to_thread(status_index.compact)
+    await asyncio.to_thread(status_index.close)
+
+    # A copy of the url cache is kept for the next runs, its ttl and revalidation apply across them
+    local_url_cache_path = job.path('url_cache.sqlite3')
+    await asyncio.to_thread(get_url_cache().backup, local_url_cache_path)
+
+    # The index and the url cache are uploaded at the same time
+    uploaded = await asyncio.to_thread(upload_files_to_s3, [
+        (local_status_path, url_status_S3),
+        (local_url_cache_path, url_cache_S3),
+    ], bucket_name)
+    remove_local_file(local_url_cache_path)
+
+    if not uploaded:
+        # The checkpoint keeps the results, the job run again starts from it
+        await asyncio.to_thread(checkpoint.save)
+        raise RuntimeError(f"The url status index or the url cache couldn't be uploaded to '{url_status_S3}' / '{url_cache_S3}', the checkpoint is kept")
+
+    # The results are saved, the next run starts from the start
+    await asyncio.to_thread(checkpoint.clear)
 
     print("[INFO] Deleting files from local...")
 
     # We remove the files from the app directory
-    remove_local_file(local_data_path)
-    remove_local_file(local_checked_path)
-    remove_local_file(local_failed_path)
+    remove_local_file(local_status_path)
+    remove_local_file(status_index.log_path)
 
     gc.collect()
 
-async def process_images(
-    data_file_S3: str = Form(None),
-    data_file_S3_post_urls_clean_up : str = Form(None),
-    data_file_S3_post_images_clean_up : str = Form(None)
-    ):
+async def process_images(data_file_S3, data_file_S3_post_urls_clean_up, data_file_S3_post_images_clean_up, job):
+    async with classification_cache_lock:
+        await check_images_file(data_file_S3, data_file_S3_post_urls_clean_up, data_file_S3_post_images_clean_up, job)
+
+async def check_images_file(data_file_S3, data_file_S3_post_urls_clean_up, data_file_S3_post_images_clean_up, job):
 
     # S3 bucket from the project and files
     bucket_name = 'nutritious.app'
 
-    # Local file paths to save the file
-    local_data_path = 'local_data.csv'
+    # Results of the classification of the previous runs
+    classification_cache_S3 = 'files/classification_cache.sqlite3'
+
+    # Local file path of the cache, the data is uploaded from memory
+    local_classification_cache_path = job.path('classification_cache.sqlite3')
 
     print("[INFO] Loading file from S3...")
 
+    # The transfers are blocking, they run in a thread so the app keeps answering
     try:
         if data_file_S3:
-            df = load_csv_from_s3(bucket_name, data_file_S3, sep='\t')
+            df = await asyncio.to_thread(load_csv_from_s3, bucket_name, data_file_S3, sep='\t')
 
         elif data_file_S3_post_urls_clean_up:
-            df = load_csv_from_s3(bucket_name, data_file_S3_post_urls_clean_up, sep='\t')
+            df = await asyncio.to_thread(load_csv_from_s3, bucket_name, data_file_S3_post_urls_clean_up, sep='\t')
     except Exception as e:
         logger.info("status: error")
         logger.info(f"message: {str(e)}")
 
+    await asyncio.to_thread(download_file_from_s3, bucket_name, classification_cache_S3, local_classification_cache_path)
+    classification_cache = ClassificationCache(local_classification_cache_path)
+
     print("[INFO] Checking images...")
 
-    # Calling function to check images in dataframe
-    df = check_data_image(df)
+    # Calling function to check images in dataframe, in a thread so the app keeps answering
+    df = await asyncio.to_thread(check_data_image, df, classification_cache, job.advance)
+    classification_cache.close()
 
     # We clean the data
     df = df[df.image_1.notna()].copy()
 
-    print("[INFO] Creating file in local...")
-
-    # Create file in path
-    df.to_csv(local_data_path, sep = "\t", index=None)
+    print("[INFO] Uploading files to S3...")
 
-    print("[INFO] Uploading file to S3...")
+    # The data is written in a buffer (in a thread), then uploaded at the same time as the cache
+    data_buffer = await asyncio.to_thread(csv_buffer, df)
 
-    # We upload the new file
-    upload_file_to_s3(local_data_path, bucket_name, data_file_S3_post_images_clean_up)
+    await asyncio.to_thread(upload_files_to_s3, [
+        (data_buffer, data_file_S3_post_images_clean_up),
+        (local_classification_cache_path, classification_cache_S3),
+    ], bucket_name)
 
     print("[INFO] Deleting files in local...")
 
     # We remove the files from the app directory
-    remove_local_file(local_data_path)
+    remove_local_file(local_classification_cache_path)
 
     gc.collect()
 
+# Functions of the jobs, from the parameters of the endpoints
+async def clean_up_job(job):
+    params = job.params
+    await process_urls(params["data_file_S3"], params["data_file_S3_post_urls_clean_up"], job)
+    await process_images(params["data_file_S3_post_urls_clean_up"], None, params["data_file_S3_post_images_clean_up"], job)
+
+async def urls_job(job):
+    params = job.params
+    await process_urls(params["data_file_S3"], params["data_file_S3_post_urls_clean_up"], job)
+
+async def images_job(job):
+    params = job.params
+    await process_images(params["data_file_S3"], params["data_file_S3_post_urls_clean_up"], params["data_file_S3_post_images_clean_up"], job)
+
+job_runner.register("clean-up-data", clean_up_job)
+job_runner.register("process-data-urls", urls_job)
+job_runner.register("process-data-image", images_job)
+
+@app.on_event("startup")
+async def resume_jobs():
+    # The jobs stopped with the previous process are launched again
+    job_runner.resume()
+
 @app.post("/clean-up-data/")
 async def process_image_endpoint(
-    background_tasks: BackgroundTasks,
     data_file_S3: str = Form(None),
     data_file_S3_post_urls_clean_up : str = Form(None),
     data_file_S3_post_images_clean_up : str = Form(None)
     ):
-    
-    background_tasks.add_task(process_urls, data_file_S3, data_file_S3_post_urls_clean_up)
 
-    background_tasks.add_task(process_images, data_file_S3_post_urls_clean_up, data_file_S3_post_images_clean_up)
-    
-    return {"message": "Operation launched in background"}
+    job_id = job_runner.submit("clean-up-data", {
+        "data_file_S3": data_file_S3,
+        "data_file_S3_post_urls_clean_up": data_file_S3_post_urls_clean_up,
+        "data_file_S3_post_images_clean_up": data_file_S3_post_images_clean_up,
+    })
+
+    return {"message": "Operation launched in background", "job_id": job_id}
 
 @app.post("/process-data-urls/")
 async def process_urls_endpoint(
-    background_tasks: BackgroundTasks,
     data_file_S3: str = Form(None),
     data_file_S3_post_urls_clean_up : str = Form(None)
     ):
 
-    background_tasks.add_task(process_urls, data_file_S3, data_file_S3_post_urls_clean_up)
+    job_id = job_runner.submit("process-data-urls", {
+        "data_file_S3": data_file_S3,
+        "data_file_S3_post_urls_clean_up": data_file_S3_post_urls_clean_up,
+    })
 
-    return {"message": "Url processing operation launched in the background"}
+    return {"message": "Url processing operation launched in the background", "job_id": job_id}
 
 @app.post("/process-data-image/")
 async def process_image_endpoint(
-    background_tasks: BackgroundTasks,
     data_file_S3: str = Form(None),
     data_file_S3_post_urls_clean_up : str = Form(None),
     data_file_S3_post_images_clean_up : str = Form(None)
     ):
 
-    if data_file_S3:
-        background_tasks.add_task(process_urls, data_file_S3, data_file_S3_post_images_clean_up)
-    elif data_file_S3_post_urls_clean_up:
-        background_tasks.add_task(process_urls, data_file_S3_post_urls_clean_up, data_file_S3_post_images_clean_up)
+    job_id = job_runner.submit("process-data-image", {
+        "data_file_S3": data_file_S3,
+        "data_file_S3_post_urls_clean_up": data_file_S3_post_urls_clean_up,
+        "data_file_S3_post_images_clean_up": data_file_S3_post_images_clean_up,
+    })
+
+    return {"message": "Image processing operation launched in the background", "job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    # Status of the job, and the counters of its stages (done, total, per_second)
+    job = job_store.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
 
-    return {"message": "Url processing operation launched in the background"}
+    return job
 
 @app.post("/keep-alive/")
 async def keeping_alive():
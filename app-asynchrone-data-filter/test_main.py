@@ -1,8 +1,28 @@
 # run pytest in the folder to test
 
+import io
+import os
+import tempfile
+import boto3
+import numpy as np
+import pandas as pd
+from moto import mock_aws
 from fastapi.testclient import TestClient
 
+# The files of the tests (jobs, url cache, checkpoints) are written in a temporary folder, not in the app
+test_dir = tempfile.mkdtemp()
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(test_dir, "jobs.sqlite3"))
+os.environ.setdefault("JOBS_DIR", os.path.join(test_dir, "jobs"))
+os.environ.setdefault("URL_CACHE_PATH", os.path.join(test_dir, "url_cache.sqlite3"))
+os.environ.setdefault("CHECKPOINT_DIR", os.path.join(test_dir, "checkpoints"))
+
 from main import app
+from functions import check_images, check_urls
+from functions.check_urls import generate_urls, get_image
+from functions.s3_functions import upload_files_to_s3, iter_csv_chunks_from_s3, reset_s3_client
+from functions.url_status import UrlStatusIndex, encode_records, url_keys, FAILED_BIT, KEY_MASK
+from functions.url_cache import get_url_cache
+from functions.classification_cache import ClassificationCache
 
 client = TestClient(app)
 
@@ -25,4 +45,227 @@ def test_process_image_endpoint():
     
     response = client.post("/process-data-image/", data=test_data)
 
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+def test_generate_urls_same_as_get_image():
+
+    codes = [3017620422003, "0042", "12345678", "123456789", "5449000000996", "12345678901234"]
+
+    df = generate_urls(pd.DataFrame({"code": codes}))
+
+    for i in range(1, 5):
+        assert df[f"image_{i}"].tolist() == [get_image(str(code), number = f"{i}.400") for code in codes]
+
+def test_job_status_endpoint():
+
+    test_data = {"data_file_S3": 'files/cleaned_data_test.csv', "data_file_S3_post_urls_clean_up": 'files/cleaned_image_data_test.csv'}
+
+    response = client.post("/process-data-urls/", data=test_data)
+    job_id = response.json()["job_id"]
+
+    response = client.get(f"/jobs/{job_id}")
+
+    assert response.status_code == 200
+    assert response.json()["type"] == "process-data-urls"
+    assert response.json()["status"] in ["queued", "running", "done", "failed"]
+
+    response = client.get("/jobs/unknown")
+
+    assert response.status_code == 404
+
+@mock_aws
+def test_upload_files_to_s3():
+
+    # The shared client is created again inside the mocked S3
+    reset_s3_client()
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket="test-bucket")
+
+    local_path = os.path.join(tempfile.mkdtemp(), "state.bin")
+    with open(local_path, "wb") as file:
+        file.write(b"state")
+
+    df = pd.DataFrame({"code": ["0042", "3017620422003"]})
+    upload_files_to_s3([
+        (io.BytesIO(df.to_csv(sep="\t", index=None).encode()), "files/data.csv"),
+        (b"buffer", "files/buffer.bin"),
+        (local_path, "files/state.bin"),
+    ], "test-bucket")
+
+    data = s3.get_object(Bucket="test-bucket", Key="files/data.csv")["Body"].read()
+    assert pd.read_csv(io.BytesIO(data), sep="\t", dtype=str).equals(df)
+    assert s3.get_object(Bucket="test-bucket", Key="files/buffer.bin")["Body"].read() == b"buffer"
+    assert s3.get_object(Bucket="test-bucket", Key="files/state.bin")["Body"].read() == b"state"
+
+    reset_s3_client()
+
+@mock_aws
+def test_generate_urls_by_chunks_same_as_whole_file():
+
+    reset_s3_client()
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket="test-bucket")
+
+    # The chunk boundaries don't change the type of the codes
+    df = pd.DataFrame({"code": ["00012345", "abc123", "3017620422003", "0042", "5449000000996"], "product_name": ["a", "b", "c", "d", "e"]})
+    s3.put_object(Bucket="test-bucket", Key="files/data.csv", Body=df.to_csv(sep="\t", index=None).encode())
+
+    whole_file = generate_urls(pd.read_csv(io.BytesIO(df.to_csv(sep="\t", index=None).encode()), sep="\t"))
+    chunks = pd.concat([generate_urls(chunk) for chunk in iter_csv_chunks_from_s3("test-bucket", "files/data.csv", sep="\t", chunksize=2)], ignore_index=True)
+
+    assert chunks["code"].tolist() == df["code"].tolist()
+    for i in range(1, 5):
+        assert chunks[f"image_{i}"].tolist() == whole_file[f"image_{i}"].tolist()
+
+    reset_s3_client()
+
+def test_url_status_index():
+
+    path = os.path.join(tempfile.mkdtemp(), "url_status.npy")
+    index = UrlStatusIndex.from_sets(path, {"http://a/1.jpg", "http://a/2.jpg"}, {"http://a/2.jpg"})
+
+    # The status bit is the lowest bit of the record, the key the 63 others
+    records = encode_records(["http://a/1.jpg", "http://a/1.jpg"], [False, True])
+    assert records[0] & FAILED_BIT == 0 and records[1] & FAILED_BIT == FAILED_BIT
+    assert records[0] & KEY_MASK == records[1] & KEY_MASK
+
+    # The log is more recent than the sorted file, the last record of a url wins
+    index.add("http://a/3.jpg", True)
+    index.add("http://a/2.jpg", False)
+    index.add("http://a/3.jpg", False)
+
+    urls = ["http://a/1.jpg", "http://a/2.jpg", "http://a/3.jpg", "http://a/4.jpg"]
+    expected_checked, expected_failed = [True, True, True, False], [False, False, False, False]
+
+    checked, failed = index.lookup(urls)
+    assert checked.tolist() == expected_checked and failed.tolist() == expected_failed
+
+    # Same status once the log is merged in the sorted file, and once the file is opened again
+    index.compact()
+    assert len(index.log) == 0 and len(index) == 3
+    index.close()
+
+    index = UrlStatusIndex(path)
+    checked, failed = index.lookup(urls)
+    assert checked.tolist() == expected_checked and failed.tolist() == expected_failed
+    index.close()
+
+def reference_check_data_image(df, classify):
+    # Front/Back selection of the former check_type_data_image (lists of labels), classify(urls) gives the results
+    back_images = df.index
+
+    for type_image in ["image_1", "image_2", "image_3", "image_4"]:
+        if len(back_images) == 0:
+            break
+
+        initial_df = df[df.index.isin(back_images)]
+        results_images = classify(initial_df[type_image].to_list())
+
+        initial_df_index = initial_df.index.to_list()
+        index = [i for i, value in enumerate(results_images) if value == "1"]
+        front_images = [value for i, value in enumerate(initial_df_index) if i in index]
+
+        if type_image != "image_1":
+            df.loc[df.index.isin(front_images), ["image_1", type_image]] = df.loc[df.index.isin(front_images), [type_image, "image_1"]].to_numpy()
+
+        index = [i for i, value in enumerate(results_images) if value != "1"]
+        back_images = [value for i, value in enumerate(initial_df_index) if i in index]
+
+        if type_image == "image_4":
+            df.loc[df.index.isin(back_images), ["image_1", "image_2", "image_3", "image_4"]] = None
+
+    return df
+
+def test_check_data_image_same_as_reference(monkeypatch):
+
+    rng = np.random.default_rng(0)
+    size = 60
+
+    # Urls of the images, some missing, and the front images chosen at random
+    df = pd.DataFrame({f"image_{i}": [f"http://img/{j}/{i}.jpg" if rng.random() > 0.1 else None for j in range(size)] for i in range(1, 5)},
+                      index=rng.permutation(np.arange(1000, 1000 + size)))
+    front = {url for url in df.to_numpy().ravel() if url is not None and rng.random() < 0.3}
+
+    def classify(contents):
+        return ["1" if content in front else "0" for content in contents]
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        def __init__(self, url):
+            self.content = url
+
+    def retrieve(url, headers=None):
+        return Response(url) if str(url).startswith("http") else None
+
+    monkeypatch.setattr(check_images, "retrieve_url_content", retrieve)
+    monkeypatch.setattr(check_images, "model_front_classification_batch", classify)
+
+    expected = reference_check_data_image(df.copy(), lambda urls: classify([url if str(url).startswith("http") else "None" for url in urls]))
+    result = check_images.check_data_image(df.copy())
+
+    assert result.equals(expected)
+    assert not result.equals(df)
+
+def test_classification_cache_needs_a_fresh_url_check(monkeypatch):
+
+    url = "http://img/etag/1.jpg"
+    classification_cache = ClassificationCache(os.path.join(tempfile.mkdtemp(), "classification_cache.sqlite3"))
+    classification_cache.set(url, "1", etag="e1")
+
+    requests_headers = []
+
+    class Response:
+        status_code = 304
+        headers = {}
+        content = b""
+
+    def retrieve(url, headers=None):
+        requests_headers.append(headers)
+        return Response()
+
+    monkeypatch.setattr(check_images, "retrieve_url_content", retrieve)
+
+    # Same ETag seen by a recent url check: the result is used without request
+    get_url_cache().set(url, True, 200, etag="e1")
+    assert check_images.classify_images([url], classification_cache=classification_cache) == ["1"]
+    assert requests_headers == []
+
+    # The url check is older than the ttl: the image may have changed, it is asked with its ETag
+    monkeypatch.setattr(get_url_cache(), "ttl", -1)
+    assert check_images.classify_images([url], classification_cache=classification_cache) == ["1"]
+    assert requests_headers == [{"If-None-Match": "e1"}]
+
+    classification_cache.close()
+
+def test_stale_urls_are_checked_again(monkeypatch):
+
+    url = "http://img/stale/1.jpg"
+    index = UrlStatusIndex.from_sets(os.path.join(tempfile.mkdtemp(), "url_status.npy"), {url}, set())
+    df = pd.DataFrame({"image_1": [url], "image_2": [None], "image_3": [None], "image_4": [None]})
+
+    checked_urls = []
+
+    async def check(client, url, host_limits):
+        # The image was removed since the first check
+        checked_urls.append(url)
+        return False, None
+
+    monkeypatch.setattr(check_urls, "check_url_image_async", check)
+
+    # Within the ttl, the url of the index is not checked again
+    get_url_cache().set(url, True, 200)
+    assert get_url_cache().lookup_many([url]) == {url: True} and url not in get_url_cache().stale_urls()
+    check_urls.testing_urls_data(df, index)
+    assert checked_urls == []
+
+    # Once the ttl is over, the url is checked again and its new status replaces the one of the index
+    monkeypatch.setattr(get_url_cache(), "ttl", -1)
+    assert get_url_cache().lookup_many([url]) == {} and url in get_url_cache().stale_urls()
+    check_urls.testing_urls_data(df, index, stale_keys=url_keys(get_url_cache().stale_urls()))
+    assert checked_urls == [url]
+
+    checked, failed = index.lookup([url])
+    assert checked.tolist() == [True] and failed.tolist() == [True]
+    index.close()
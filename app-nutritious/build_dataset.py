@@ -0,0 +1,62 @@
+"""
+    Build the columnar artifact of the dataset, loaded by the app at startup.
+
+    From a local csv:
+        python build_dataset.py --input files_dash/cleaned_img_data.csv
+    From the csv in the S3 bucket, uploading the artifact next to it:
+        python build_dataset.py --s3-key files/cleaned_img_data.csv --upload
+"""
+import argparse
+import io
+import os
+import logging
+import pandas as pd
+import boto3
+from functions.dataset import prepare_dataset, write_artifact, artifact_path_from_csv, local_csv_source
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Build the dataset artifact of the app")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="Path to the cleaned csv file (tab separated)")
+    source.add_argument("--s3-key", help="Key of the cleaned csv file in the S3 bucket")
+    parser.add_argument("--output", help="Path of the artifact, next to the csv by default")
+    parser.add_argument("--upload", action="store_true", help="Upload the artifact next to the csv in the S3 bucket")
+
+    return parser.parse_args()
+
+def main():
+    arguments = parse_arguments()
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+
+    if (arguments.s3_key or arguments.upload) and bucket_name is None:
+        raise EnvironmentError("The 'S3_BUCKET_NAME' environment variable is not set.")
+
+    if arguments.input:
+        logger.info(f"Reading '{arguments.input}'...")
+        df = pd.read_csv(arguments.input, sep="\t")
+        source = local_csv_source(arguments.input)
+        output = arguments.output or artifact_path_from_csv(arguments.input)
+    else:
+        logger.info(f"Reading '{arguments.s3_key}' from S3 bucket...")
+        response = boto3.client('s3').get_object(Bucket=bucket_name, Key=arguments.s3_key)
+        df = pd.read_csv(io.BytesIO(response['Body'].read()), sep="\t")
+        # The app uses the artifact while the ETag of the csv is the same
+        source = response['ETag'].strip('"')
+        output = arguments.output or os.path.basename(artifact_path_from_csv(arguments.s3_key))
+
+    logger.info("Preparing the dataset...")
+    df = prepare_dataset(df)
+
+    write_artifact(df, output, source)
+
+    if arguments.upload:
+        object_key = artifact_path_from_csv(arguments.s3_key or 'files/cleaned_img_data.csv')
+        boto3.client('s3').upload_file(output, bucket_name, object_key)
+        logger.info(f"Uploaded '{output}' to '{object_key}'")
+
+if __name__ == '__main__':
+    main()
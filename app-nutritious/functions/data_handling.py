@@ -1,11 +1,20 @@
 ﻿import pandas as pd
-import copy
 import os
+import glob
+import json
+import hashlib
+import numpy as np
+import tempfile
 from io import StringIO
 import boto3
 import logging
 from dash import html, get_asset_url
 from functions.language import get_translate
+from functions.product_store import ProductStore
+from functions.slice_cache import SliceCache
+from functions.ranking import RankingIndex, TYPE_DIET, top_k
+from functions.search_index import SearchIndex
+from functions.dataset import prepare_dataset, read_artifact, artifact_path_from_csv, local_csv_source, DERIVED_COLUMNS
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +26,13 @@ bucket_name = os.environ.get('S3_BUCKET_NAME')
 if bucket_name is None:
     raise EnvironmentError("The 'S3_BUCKET_NAME' environment variable is not set.")
 
+# Path to the cleaned file and to its artifact in the S3 bucket
+data_file = 'files/cleaned_img_data.csv'
+artifact_file = artifact_path_from_csv(data_file)
+
+# Folder keeping the artifact downloaded from S3, shared by the workers
+artifact_dir = os.environ.get('ARTIFACT_DIR', tempfile.gettempdir())
+
 # We retrieve the language dictionnary
 translations = get_translate()
 
@@ -27,11 +43,7 @@ def get_data():
 # Return a list with the name of the countries in the dataset
 def get_unique_countries():
     # Options setup for dropdown of countries
-    c1 = [country.split(",") for country in data.countries_en.unique()]
-    c2 = [count for country in c1 for count in country]
-    unique_countries = sorted(list(set(c2)))
-
-    return unique_countries
+    return store.get_countries()
 
 # Return a list of dicts with the number of products by country
 def products_by_countries(language):
@@ -43,7 +55,7 @@ def products_by_countries(language):
     
     nb_products_countries = [
         {
-            'label': f"{flags[country]} {translations[language][country]} [{return_df(country).shape[0]} products]",
+            'label': f"{flags[country]} {translations[language][country]} [{store.count(country)} products]",
             'value': country
         } 
         for country in get_unique_countries()
@@ -82,57 +94,37 @@ def pnns_groups_options(country, pnns_groups_num, language, pnns1=None):
     elif pnns_groups_num == "pnns_groups_2":
         pnns_groups = data.loc[data.pnns_groups_1 == pnns1, pnns_groups_num].unique()
 
-    # Create a DataFrame with counts for each pnns group
-    counts_df = data.query('countries_en.str.contains(@country)').groupby(pnns_groups_num).size().reset_index(name='count')
-
-    # Merge the counts with the unique pnns groups
-    merged_df = pd.DataFrame({pnns_groups_num: pnns_groups})
-    merged_df = pd.merge(merged_df, counts_df, on=pnns_groups_num, how='left').fillna(0)
-    
-    merged_df.sort_values(by=pnns_groups_num, inplace=True)
+    # Number of products for each pnns group in the country, from the index
+    counts = store.group_counts(country, pnns_groups_num)
     
     # Create the pnns_groups_options list
     pnns_groups_options = [
         {
-            'label': f"{translations[language][pnns]} [{count} products]",
+            'label': f"{translations[language][pnns]} [{counts.get(pnns, 0)} products]",
             'value': pnns
         }
-        for pnns, count in zip(merged_df[pnns_groups_num], merged_df['count'])
+        for pnns in sorted(pnns_groups)
     ]
 
     return pnns_groups_options  
 
 def cache(fun):
-    cache.cache_ = {}
-
+    # The slices are kept in a bounded LRU cache, and returned as read-only views
     def inner(country, pnns1, pnns2):
-        # Check if the inputs have changed
-        inputs_changed = (
-            country not in cache.cache_ or
-            pnns1 not in cache.cache_ or
-            pnns2 not in cache.cache_
-        )
-        
         cache_key = (country, pnns1, pnns2)
 
-        if inputs_changed or cache_key not in cache.cache_:
-            cache.cache_[cache_key] = fun(country, pnns1, pnns2)
-
-        return cache.cache_[cache_key]
+        return slice_cache.get_or_set(cache_key, lambda: fun(country, pnns1, pnns2))
 
     return inner
 
+# Return the counters of the slice cache (hits, misses, evictions, memory used)
+def get_cache_stats():
+    return slice_cache.stats()
+
 @cache
 def function(country, pnns1, pnns2):
-    
-    df = data.query('countries_en.str.contains(@country)')
-    
-    if pnns2:
-        df = df.query('pnns_groups_2 == @pnns2')
-    elif pnns1:
-        df = df.query('pnns_groups_1 == @pnns1')
-
-    return df
+    # The slice comes from the intersection of the country and pnns groups indexes
+    return store.slice(country, pnns1, pnns2)
 
 def return_df(country, pnns1 = None, pnns2 = None):
 
@@ -142,7 +134,85 @@ def return_df(country, pnns1 = None, pnns2 = None):
     # Returning no data to show
     else:
         return None        
+
+def slice_spec(country, pnns1=None, pnns2=None, ranges=None):
+    """
+        Compact description of a filtered slice: the selection and the range of
+        each nutrient. It is kept in dcc.Store('sliced_file') instead of the data,
+        the server rebuilds the slice with return_sliced_df
+    """
+    spec = {'country': country, 'pnns1': pnns1, 'pnns2': pnns2, 'ranges': ranges}
+    spec['key'] = slice_spec_key(spec)
+
+    return spec
+
+def slice_spec_key(spec):
+    # Content hash of the spec, computed on the server side
+    content = {name: spec.get(name) for name in ['country', 'pnns1', 'pnns2', 'ranges']}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def filter_slice(spec):
+    df = return_df(spec['country'], spec['pnns1'], spec['pnns2'])
+
+    if df is not None and spec.get('ranges'):
+        mask = np.ones(df.shape[0], dtype=bool)
+        for nutrient, (low, high) in spec['ranges'].items():
+            # Only the nutrients of the dataset can be filtered on
+            if nutrient in df.columns:
+                values = df[nutrient].to_numpy()
+                mask &= (values >= low) & (values <= high)
+        df = df[mask]
+
+    return df
+
+def return_sliced_df(spec):
+    """
+        Return the slice described by the spec, from the cache when it was already built
+    """
+    if not spec or not spec.get('country'):
+        return None
+
+    return slice_cache.get_or_set(('sliced', slice_spec_key(spec)), lambda: filter_slice(spec))
         
+# Return the product (a DataFrame of one row) from its code, empty if not found
+def get_product(code):
+    position = store.find_code(code)
+
+    if position is None:
+        return data.iloc[[]]
+
+    return data.iloc[[position]]
+
+def get_search_index(country, search_type):
+    """
+        Return the search index of the country, on the product names or the product codes.
+        Built the first time it is asked, then kept until the data is reloaded
+    """
+    key = (country, search_type)
+
+    if key not in search_indexes:
+        df = store.slice(country)
+
+        if search_type == 'product_name':
+            # Number of products with the same name, and the lower-cased name to search on
+            names = df.groupby('product_name', sort=True)['product_name_lower'].agg(['first', 'size'])
+            index = SearchIndex(names.index, names['first'], names['size'])
+        else:
+            # Each product has its own unique code
+            codes = pd.unique(df['code'].astype(str))
+            index = SearchIndex(codes, codes, np.ones(len(codes)))
+
+        search_indexes[key] = index
+
+    return search_indexes[key]
+
+# Return the products of the country matching the query, as (value, count)
+def search_products(country, search_type, query, k=50):
+    if not country:
+        return []
+
+    return get_search_index(country, search_type).search(query, k)
+
 def get_code(url):
     # Extract the product code from the Open Food Facts image URL
     try:
@@ -161,95 +231,27 @@ def get_code(url):
 
     return None
 
-def mapping_nutriscore_IMG(df):
-    """
-        Function matching the nutriscore to the letter A to E
-        Add the column nutriscore_score_letter to the dataframe
-        We loop inside the dictionnary, and change the letter if the score is inferior.
-        Until it isn't
-    """
-    nutriscore_img = {
-        "E" : ["40", "nutriscore_E.png"], 
-        "D" : ["18", "nutriscore_D.png"],
-        "C" : ["10", "nutriscore_C.png"],
-        "B" : ["2", "nutriscore_B.png"],
-        "A" : ["-1", "nutriscore_A.png"],
-    }
-    if isinstance(df, pd.DataFrame):   
-        df["nutriscore_score_letter"] = "nutriscore_E.png"
-        for letter in nutriscore_img:
-            df.loc[: ,"nutriscore_score_letter"] = df.apply(lambda x: nutriscore_img[letter][1] 
-                                                if x["nutriscore_score"] <= int(nutriscore_img[letter][0])
-                                               else x["nutriscore_score_letter"], axis = 1)
-        return df
-
-def df_sorting(diet, df = None):
+def get_best_products(diet, n_best, df=None, selection=None):
     """
-        Function sorting the dataframe
-        ascending = True
-        Descending = False
+        Return the n_best products of the diet.
+        For a (country, pnns1, pnns2) selection, they come from the ranking index,
+        otherwise (advanced search) they are selected from the DataFrame
     """
+    if selection is not None:
+        return ranking_index.best(*selection, diet, n_best)
 
-    type_diet = {
-        "Healthier foods": [
-            {'column_id': 'nutriscore_score', 'direction': True},
-        ],
-        "Fiber rich foods": [
-            {'column_id': 'fiber_100g', 'direction': False},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Low sugar foods": [
-            {'column_id': 'carbohydrates_100g', 'direction': True},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Protein rich foods": [
-            {'column_id': 'proteins_100g', 'direction': False},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Energy rich foods": [
-            {'column_id': 'energy_100g', 'direction': False},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Low fat foods": [
-            {'column_id': 'fat_100g', 'direction': True},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Low salt foods": [
-            {'column_id': 'salt_100g', 'direction': True},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-        "Low saturated fat foods": [
-            {'column_id': 'saturated-fat_100g', 'direction': True},
-            {'column_id': 'nutriscore_score', 'direction': True}
-        ],
-    }
-    column_id = []
-    direction = []
-    
-    df_copy = copy.deepcopy(df)
-    
-    if diet in type_diet:
-        for sorting_param in type_diet[diet]:
-            
-            column_id.append(sorting_param['column_id'])
-            direction.append(sorting_param['direction'])
-            
-        if isinstance(df, pd.DataFrame):  
-            df_copy = df_copy.sort_values(by=column_id, ascending=direction)
-    
-    if isinstance(df_copy, pd.DataFrame):
-        return df_copy
-    else: 
-        return column_id
+    if diet in TYPE_DIET:
+        return top_k(df, TYPE_DIET[diet], n_best)
 
+    return df.head(n_best)
     
 # Function filling the list subtitles, images, styles_images, textes_images
-def generate_texte_image(df, diets, n_best, subtitles, images, styles_images, textes_images, language):                 
+def generate_texte_image(df, diets, n_best, subtitles, images, styles_images, textes_images, language, selection=None):                 
     for i, diet in enumerate(diets):
         subtitles[i] = html.Strong(f"{translations[language][diet]}")
         
-        # We sort, we take the n_best then we map the nutriscore label
-        df_N_best = df_sorting(diet, df).head(n_best)
+        # We take the n_best of the diet, then we map the nutriscore label
+        df_N_best = get_best_products(diet, n_best, df, selection)
 
         for y, (_, IMG) in enumerate(df_N_best.iterrows()):
             index = y if i == 0 else (20 * i) + y
@@ -288,8 +290,8 @@ def get_texte_product(row, language):
             f" {translations.get(language, {}).get(row.iloc[i], row.iloc[i])}"],
             style={'text-align': 'left', 'margin-top': '1px', 'margin-left':'10px', 'white-space': 'nowrap'}
             )
-        for i in range(len(row.iloc[:-1]))
-        if row.index[i] not in  [f"image_{i}" for i in range(1,5,1)] # To exclude images urls
+        for i in range(len(row))
+        if row.index[i] not in  [f"image_{i}" for i in range(1,5,1)] + DERIVED_COLUMNS # To exclude images urls and derived columns
     ], style={'display': 'flex', 'flex-direction': 'column', 'overflowX': 'scroll'})
     
 def find_key_by_value(my_dict, value):
@@ -306,44 +308,136 @@ def find_key_by_value(my_dict, value):
     # If the value is not found
     return None 
 
-# When debugging, it will load the file in local
-# On server, it will load from S3
-try:
-    logger.info("Loading file from local folder...")
+def download_artifact(s3):
+    """
+        Download the artifact of the dataset from S3, if there is one.
+        The local name holds the ETag: the workers of a machine share the same
+        file, and a new artifact is downloaded again.
+    """
+    try:
+        etag = s3.head_object(Bucket=bucket_name, Key=artifact_file)['ETag'].strip('"')
+    except Exception as e:
+        logger.info("status: No artifact on S3")
+        logger.info(f"message: {str(e)}")
+        return None
+
+    local_path = os.path.join(artifact_dir, f"cleaned_img_data-{etag}.arrow")
+
+    if not os.path.exists(local_path):
+        logger.info("Downloading artifact from S3 bucket...")
+        temporary_path = f"{local_path}.{os.getpid()}.tmp"
+        try:
+            s3.download_file(bucket_name, artifact_file, temporary_path)
+            os.replace(temporary_path, local_path)
+        except Exception as e:
+            # The csv file is used instead
+            logger.warning("status: Error downloading artifact")
+            logger.warning(f"message: {str(e)}")
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return None
+
+        remove_stale_artifacts(local_path)
+
+    return local_path
+
+def remove_stale_artifacts(local_path):
+    """
+        Delete the artifacts of the previous ETags, only the current one is kept.
+        A worker still mapping an old file keeps its pages until it reloads the data
+    """
+    for path in glob.glob(os.path.join(artifact_dir, "cleaned_img_data-*.arrow")):
+        if path != local_path:
+            try:
+                os.remove(path)
+                logger.info(f"Stale artifact '{path}' deleted")
+            except OSError as e:
+                logger.warning(f"Error deleting stale artifact '{path}': {str(e)}")
+
+def csv_etag(s3):
+    # Version of the csv in the S3 bucket, the artifact has to be built from it
+    try:
+        return s3.head_object(Bucket=bucket_name, Key=data_file)['ETag'].strip('"')
+    except Exception as e:
+        logger.info("status: No ETag for the csv file")
+        logger.info(f"message: {str(e)}")
+        return None
+
+def load_data():
+    """
+        Return the prepared dataset, trying in order the artifact then the csv file.
+        The artifact is only used if it was built from the current csv file.
+        When debugging, it will load the files in local
+        On server, it will load from S3
+    """
     # Get the directory of the script
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
     # Go up one level to the parent directory (assuming the script is in the 'app' directory)
     app_dir = os.path.dirname(script_dir)
 
+    # Define the path to the file in the /files directory
+    file_path = os.path.join(app_dir, 'files_dash', 'cleaned_img_data.csv')
+
+    # The artifact is memory-mapped, already prepared
+    df = read_artifact(artifact_path_from_csv(file_path), local_csv_source(file_path))
+    if df is not None:
+        logger.info("Loaded artifact from local folder")
+        return df
+
     try:
-        # Define the path to the file in the /files directory
-        file_path = os.path.join(app_dir, 'files_dash', 'cleaned_img_data.csv')
+        logger.info("Loading file from local folder...")
+
+        # Now you can use the file_path to access your file
+        with open(file_path, 'r') as file:
+            return prepare_dataset(pd.read_csv(file, sep = "\t"))
     except:
-        logger.info("status: Error")
-        logger.info(f"message: {str(e)}")
+        pass
 
-    # Now you can use the file_path to access your file
-    with open(file_path, 'r') as file:
-        data = pd.read_csv(file_path, sep = "\t")
-except:
     s3 = boto3.client('s3')
 
-    # Path to the cleaned file
-    data_file = 'files/cleaned_img_data.csv'
+    local_artifact_path = download_artifact(s3)
+    df = read_artifact(local_artifact_path, csv_etag(s3)) if local_artifact_path else None
+    if df is not None:
+        logger.info("Loaded artifact from S3 bucket")
+        return df
 
     try:
         logger.info("Loading file from S3 bucket...")
         # Read the CSV file from S3 into a Pandas DataFrame
         response = s3.get_object(Bucket=bucket_name, Key=data_file)
         content = response['Body'].read().decode('utf-8')
-        data = pd.read_csv(StringIO(content), sep='\t')
+        return prepare_dataset(pd.read_csv(StringIO(content), sep='\t'))
 
     except Exception as e:
         logger.info("status: Error downloading file")
         logger.info(f"message: {str(e)}")
+        raise
+
+def reload_data():
+    """
+        (Re)load the dataset, rebuild its index and drop the cached slices
+    """
+    global data, store, ranking_index, search_indexes
+
+    data = load_data()
+
+    # We index the products by country and pnns groups
+    store = ProductStore(data)
+
+    # The best products of each selection and diet, computed once when asked
+    ranking_index = RankingIndex(store)
+
+    # The search indexes are built by country when asked
+    search_indexes = {}
 
-# We do the mapping of nutriscore
-data = mapping_nutriscore_IMG(data)
+    slice_cache.invalidate()
 
+# Cache of the slices, its budget can be set from the config vars
+slice_cache = SliceCache(
+    max_bytes=int(os.environ.get('SLICE_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+    max_entries=int(os.environ.get('SLICE_CACHE_MAX_ENTRIES', 512)),
+    ttl=float(os.environ.get('SLICE_CACHE_TTL', 3600)),
+)
 
+reload_data()
@@ -0,0 +1,167 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    # Without pyarrow, the app falls back on the csv file
+    pa = None
+    feather = None
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# To increment when the content of the artifact changes, older artifacts are then ignored
+ARTIFACT_VERSION = "2"
+ARTIFACT_VERSION_KEY = b"nutritious_artifact_version"
+
+# Version of the csv the artifact was built from (ETag on S3, size and modification time in local)
+ARTIFACT_SOURCE_KEY = b"nutritious_artifact_source"
+
+# Columns stored as categories in the artifact
+CATEGORICAL_COLUMNS = ["countries_en", "pnns_groups_1", "pnns_groups_2", "nutriscore_score_letter"]
+
+# Upper bound of the nutriscore score for each letter, above the last one it is E
+NUTRISCORE_THRESHOLDS = [-1, 2, 10, 18]
+NUTRISCORE_IMAGES = ["nutriscore_A.png", "nutriscore_B.png", "nutriscore_C.png", "nutriscore_D.png", "nutriscore_E.png"]
+
+# Nutrients used to sort the products, each one gets a rank column
+RANKED_COLUMNS = ["nutriscore_score", "energy_100g", "fat_100g", "saturated-fat_100g", "carbohydrates_100g",
+                  "fiber_100g", "proteins_100g", "salt_100g"]
+
+# Columns computed by add_derived_columns, they are not product informations
+DERIVED_COLUMNS = ["nutriscore_score_letter", "code_normalized", "product_name_lower"] + [f"rank_{column}" for column in RANKED_COLUMNS]
+
+def mapping_nutriscore_IMG(df):
+    """
+        Function matching the nutriscore to the letter A to E
+        Add the column nutriscore_score_letter (categorical) to the dataframe
+        The score is placed between the thresholds, a missing score is E
+    """
+    if isinstance(df, pd.DataFrame):
+        scores = pd.to_numeric(df["nutriscore_score"], errors="coerce").to_numpy(dtype=float)
+        letters = np.searchsorted(NUTRISCORE_THRESHOLDS, scores, side="left")
+
+        df["nutriscore_score_letter"] = pd.Categorical.from_codes(letters, categories=NUTRISCORE_IMAGES, ordered=True)
+        return df
+
+def dense_rank(column):
+    """
+        Dense rank of the values in ascending order (1 for the smallest).
+        The missing values get 0. The order of the ranks within any slice
+        is the order of the values, they can be combined to sort on several keys.
+    """
+    codes, _ = pd.factorize(column, sort=True)
+    return (codes + 1).astype(np.int32)
+
+def add_derived_columns(df):
+    """
+        Derived columns stage, run once per dataset version (when building the artifact,
+        or when loading the csv file):
+        - nutriscore_score_letter: the nutriscore image, categorical
+        - code_normalized: the code as a string without the leading zeros
+        - product_name_lower: the lower-cased name used by the search
+        - rank_<nutrient>: the dense rank of each nutrient used to sort products
+    """
+    df = mapping_nutriscore_IMG(df)
+
+    df["code_normalized"] = df["code"].astype(str).str.strip().str.lstrip("0")
+    df["product_name_lower"] = df["product_name"].astype(str).str.lower()
+
+    for column in RANKED_COLUMNS:
+        df[f"rank_{column}"] = dense_rank(df[column])
+
+    return df
+
+def prepare_dataset(df):
+    """
+        Turn the cleaned csv into the dataset used by the app:
+        codes as strings, derived columns and categorical columns
+    """
+    df["code"] = df["code"].astype(str)
+
+    df = add_derived_columns(df)
+
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = df[column].astype("category")
+
+    return df
+
+def write_artifact(df, path, source=None):
+    """
+        Write the prepared dataset as an uncompressed feather (Arrow IPC) file,
+        uncompressed so that it can be memory-mapped when loaded
+        source is the version of the csv it comes from, kept in the metadata
+    """
+    if pa is None:
+        raise ImportError("pyarrow is needed to write the dataset artifact.")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # The missing values of the float columns are kept as NaN instead of nulls:
+    # a column without nulls is read from the mapped memory without copy
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count:
+            values = df[field.name].to_numpy(dtype=field.type.to_pandas_dtype())
+            table = table.set_column(i, field, pa.array(values, type=field.type, from_pandas=False))
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[ARTIFACT_VERSION_KEY] = ARTIFACT_VERSION.encode()
+    if source is not None:
+        metadata[ARTIFACT_SOURCE_KEY] = source.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # Written next to the destination then moved, a reader never sees a partial file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, temporary_path, compression="uncompressed")
+    os.replace(temporary_path, path)
+
+    logger.info(f"Dataset artifact written to '{path}' ({df.shape[0]} products)")
+
+def read_artifact(path, source=None):
+    """
+        Memory-map the feather file. The numeric columns (the floats with NaN included)
+        stay on the mapped pages, shared between the workers of the machine.
+        The text columns are converted to Python strings and the categorical
+        columns to pandas categories: they are copied in each worker.
+        With source (the version of the current csv), an artifact built
+        from another version of the csv is not used.
+        Return None if the file can't be used.
+    """
+    if pa is None or not os.path.exists(path):
+        return None
+
+    try:
+        table = feather.read_table(path, memory_map=True)
+    except Exception as e:
+        logger.warning(f"Error reading artifact '{path}': {str(e)}")
+        return None
+
+    version = (table.schema.metadata or {}).get(ARTIFACT_VERSION_KEY, b"").decode()
+    if version != ARTIFACT_VERSION:
+        logger.warning(f"Artifact '{path}' has version '{version}', expected '{ARTIFACT_VERSION}'")
+        return None
+
+    artifact_source = (table.schema.metadata or {}).get(ARTIFACT_SOURCE_KEY, b"").decode()
+    if source is not None and artifact_source != source:
+        logger.warning(f"Artifact '{path}' was built from csv '{artifact_source}', the current csv is '{source}'")
+        return None
+
+    # split_blocks avoids consolidating the columns, so they stay on the mapped memory
+    return table.to_pandas(split_blocks=True)
+
+def local_csv_source(path):
+    # Version of a local csv, None if there is no file
+    if not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def artifact_path_from_csv(path):
+    # files/cleaned_img_data.csv -> files/cleaned_img_data.arrow
+    return os.path.splitext(path)[0] + ".arrow"
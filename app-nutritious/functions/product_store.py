@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+
+class ProductStore:
+    """
+        Index of the products built once, when the dataset is loaded.
+        For each country and each pnns group we keep the sorted positions of
+        the rows belonging to it, so a (country, pnns1, pnns2) slice is the
+        intersection of two arrays instead of a scan of the whole dataset.
+    """
+
+    def __init__(self, df):
+        self.df = df
+
+        self.countries = build_countries_index(df["countries_en"])
+
+        self.pnns_groups = {}
+        self.pnns_codes = {}
+        for column in ["pnns_groups_1", "pnns_groups_2"]:
+            self.pnns_groups[column] = build_index(df[column])
+            # Factorized column, used to count the products by group
+            self.pnns_codes[column] = pd.factorize(df[column])
+
+        self.codes = build_code_index(df["code"], df["code_normalized"])
+
+    def get_countries(self):
+        return sorted(self.countries)
+
+    def count(self, country):
+        return len(self.countries.get(country, ()))
+
+    def positions(self, country, pnns1=None, pnns2=None):
+        # Sorted positions of the rows matching the selection
+        positions = self.countries.get(country, np.empty(0, dtype=np.int64))
+
+        if pnns2:
+            group = self.pnns_groups["pnns_groups_2"].get(pnns2, np.empty(0, dtype=np.int64))
+        elif pnns1:
+            group = self.pnns_groups["pnns_groups_1"].get(pnns1, np.empty(0, dtype=np.int64))
+        else:
+            return positions
+
+        return np.intersect1d(positions, group, assume_unique=True)
+
+    def slice(self, country, pnns1=None, pnns2=None):
+        return self.df.iloc[self.positions(country, pnns1, pnns2)]
+
+    def find_code(self, code):
+        # Position of the product, whatever the writing of its code, None if not found
+        code = str(code).strip()
+
+        for form in [code, code.lstrip("0"), code.zfill(13)]:
+            position = self.codes.get(form)
+            if position is not None:
+                return position
+
+        return None
+
+    def group_counts(self, country, pnns_groups_num):
+        # Return {pnns group: number of products} inside the country
+        codes, uniques = self.pnns_codes[pnns_groups_num]
+        country_codes = codes[self.countries.get(country, np.empty(0, dtype=np.int64))]
+
+        # The code -1 is given to the missing values
+        counts = np.bincount(country_codes[country_codes >= 0], minlength=len(uniques))
+
+        return dict(zip(uniques, counts.tolist()))
+
+
+# Return {value: sorted positions of the rows holding that value}
+def build_index(column):
+    return {
+        value: positions.astype(np.int64)
+        for value, positions in column.groupby(column, observed=True, sort=True).indices.items()
+    }
+
+
+# Same as build_index, but a row can belong to several countries ("France,Germany")
+def build_countries_index(column):
+    countries = pd.Series(column.astype(object).fillna("").astype(str).to_numpy(), index=np.arange(len(column), dtype=np.int64))
+    countries = countries.str.split(",").explode().str.strip()
+    countries = countries[countries != ""]
+
+    return {
+        country: np.unique(countries.index[positions].to_numpy(dtype=np.int64))
+        for country, positions in countries.groupby(countries, sort=True).indices.items()
+    }
+
+
+# Return {code: position}, for the code as written, without its leading zeros
+# (the code_normalized column of the dataset) and as a 13 digits EAN
+def build_code_index(column, normalized):
+    codes = column.astype(str).str.strip()
+    positions = np.arange(len(codes), dtype=np.int64)
+
+    index = {}
+    # The exact writing overwrites the others, and in reversed order the first product wins
+    for form in [codes.str.zfill(13), normalized, codes]:
+        index.update(zip(form.to_numpy()[::-1], positions[::-1].tolist()))
+
+    return index
@@ -0,0 +1,143 @@
+import threading
+import numpy as np
+
+# Sorting of the products for each diet
+# ascending = True
+# Descending = False
+TYPE_DIET = {
+    "Healthier foods": [
+        {'column_id': 'nutriscore_score', 'direction': True},
+    ],
+    "Fiber rich foods": [
+        {'column_id': 'fiber_100g', 'direction': False},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Low sugar foods": [
+        {'column_id': 'carbohydrates_100g', 'direction': True},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Protein rich foods": [
+        {'column_id': 'proteins_100g', 'direction': False},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Energy rich foods": [
+        {'column_id': 'energy_100g', 'direction': False},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Low fat foods": [
+        {'column_id': 'fat_100g', 'direction': True},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Low salt foods": [
+        {'column_id': 'salt_100g', 'direction': True},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+    "Low saturated fat foods": [
+        {'column_id': 'saturated-fat_100g', 'direction': True},
+        {'column_id': 'nutriscore_score', 'direction': True}
+    ],
+}
+
+def rank_sort_key(ranks, ascending):
+    """
+        Turn a dense rank column (0 = missing value) into a key sorted in ascending order.
+        As with DataFrame.sort_values, the missing values are placed last in both directions.
+    """
+    max_rank = int(ranks.max()) if len(ranks) else 0
+
+    key = ranks.astype(np.int64) if ascending else (max_rank + 1 - ranks.astype(np.int64))
+    key[ranks == 0] = max_rank + 2
+
+    return key
+
+def column_sort_key(values, ascending):
+    """
+        Key of a numeric column, sorted in ascending order.
+        The missing values are placed last in both directions.
+    """
+    key = values.astype(float) if ascending else -values.astype(float)
+    key[np.isnan(key)] = np.inf
+
+    return key
+
+def lexicographic_top_k(keys, k):
+    """
+        Positions of the k first rows in the lexicographic order of keys
+        (the first key first, every key ascending), ties keep their original order.
+        The first key is partitioned with np.argpartition, only the rows
+        up to its k-th value are sorted: O(n) instead of O(n log n).
+    """
+    n = len(keys[0]) if keys else 0
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if k < n:
+        primary = keys[0]
+        kth_value = primary[np.argpartition(primary, k - 1)[k - 1]]
+        # The rows tied with the k-th value are kept, the next keys decide between them
+        candidates = np.flatnonzero(primary <= kth_value)
+    else:
+        candidates = np.arange(n)
+
+    # np.lexsort sorts on the last key first, and is stable
+    order = np.lexsort([key[candidates] for key in reversed(keys)])
+
+    return candidates[order[:k]]
+
+def top_k(df, sort_spec, k):
+    """
+        Return the k first rows of df ordered by sort_spec, a list of
+        {'column_id': column, 'direction': ascending} as in TYPE_DIET.
+        Same result as sort_values(...).head(k), without copying or sorting df.
+    """
+    keys = [column_sort_key(df[param['column_id']].to_numpy(dtype=float, na_value=np.nan), param['direction'])
+            for param in sort_spec]
+
+    return df.iloc[lexicographic_top_k(keys, k)]
+
+
+class RankingIndex:
+    """
+        Ordered positions of the best products for each (country, pnns1, pnns2, diet).
+        The ranking only changes with the dataset: it is computed the first time it is
+        asked, from the rank columns, then kept. A new index is built when the data is reloaded.
+    """
+
+    def __init__(self, store, n_best=20):
+        self.store = store
+        self.n_best = n_best
+
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+        # Rank columns of the whole dataset, sliced by positions
+        self._ranks = {
+            column: store.df[f"rank_{column}"].to_numpy()
+            for column in {param['column_id'] for diet in TYPE_DIET.values() for param in diet}
+        }
+
+    def positions(self, country, pnns1, pnns2, diet):
+        key = (country, pnns1, pnns2, diet)
+
+        ranking = self._rankings.get(key)
+        if ranking is None:
+            ranking = self._compute(country, pnns1, pnns2, diet)
+            with self._lock:
+                self._rankings[key] = ranking
+
+        return ranking
+
+    def best(self, country, pnns1, pnns2, diet, n_best):
+        return self.store.df.iloc[self.positions(country, pnns1, pnns2, diet)[:n_best]]
+
+    def _compute(self, country, pnns1, pnns2, diet):
+        positions = self.store.positions(country, pnns1, pnns2)
+
+        # Without diet, the products keep the order of the dataset
+        if diet not in TYPE_DIET:
+            return positions[:self.n_best]
+
+        keys = [rank_sort_key(self._ranks[param['column_id']][positions], param['direction'])
+                for param in TYPE_DIET[diet]]
+
+        return positions[lexicographic_top_k(keys, self.n_best)]
@@ -0,0 +1,59 @@
+import numpy as np
+
+# Length of the n-grams indexed
+NGRAM = 3
+
+def ngrams(text, n=NGRAM):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class SearchIndex:
+    """
+        Trigram index on the distinct values of a column (product names or codes).
+        A query is matched with the intersection of the postings of its trigrams,
+        then the remaining candidates are checked, so only a few values are scanned.
+    """
+
+    def __init__(self, values, keys, counts):
+        # values: displayed values, keys: lower-cased values searched on, counts: number of products
+        self.values = np.asarray(values, dtype=object)
+        self.keys = list(keys)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+        postings = {}
+        for i, key in enumerate(self.keys):
+            for gram in ngrams(key):
+                postings.setdefault(gram, []).append(i)
+
+        self.postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+    def search(self, query, k=50):
+        """
+            Return the k values containing the query (case insensitive) as
+            (value, count), the most frequent first
+        """
+        query = str(query).lower()
+        grams = ngrams(query)
+
+        if grams:
+            candidates = None
+            # Smallest postings first, the intersection shrinks quickly
+            for gram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+                ids = self.postings.get(gram)
+                if ids is None:
+                    return []
+                candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+                if len(candidates) == 0:
+                    return []
+        else:
+            # Query shorter than a trigram, every value is a candidate
+            candidates = np.arange(len(self.keys))
+
+        matches = np.array([i for i in candidates if query in self.keys[i]], dtype=np.int64)
+        if len(matches) == 0:
+            return []
+
+        # Most frequent first, then in alphabetical order (the order of the values)
+        order = np.lexsort((matches, -self.counts[matches]))[:k]
+
+        return [(self.values[i], int(self.counts[i])) for i in matches[order]]
@@ -0,0 +1,122 @@
+import threading
+import time
+import pandas as pd
+from collections import OrderedDict
+
+
+def copy_on_write():
+    # Always on from pandas 3, before it depends on the option (main.py enables it)
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    return pd.get_option("mode.copy_on_write") is True
+
+def handed_out(df):
+    """
+        Frame given to the callers: a shallow copy with copy on write,
+        it behaves as a read-only view. Without it (a script or a test
+        importing the functions without main.py) a deep copy, a change
+        to the slice never reaches the cached frame
+    """
+    return df.copy(deep=not copy_on_write())
+
+
+class SliceCache:
+    """
+        LRU cache of the (country, pnns1, pnns2) slices of the dataset.
+        The cache is bounded by a number of entries, a memory budget (in bytes,
+        from DataFrame.memory_usage) and a time to live.
+        The cached frames are never handed out, callers receive a copy (see handed_out).
+    """
+
+    def __init__(self, max_bytes, max_entries=512, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict() # key: (DataFrame, size in bytes, time of insertion)
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            # Most recently used at the end
+            self._entries.move_to_end(key)
+            return handed_out(entry[0])
+
+    def put(self, key, df, generation=None):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+
+        with self._lock:
+            # The dataset was reloaded while computing the slice
+            if generation is not None and generation != self.generation:
+                return
+            # Bigger than the whole budget, we don't keep it
+            if size > self.max_bytes:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (df, size, time.monotonic())
+            self.current_bytes += size
+
+            # We evict the least recently used slices
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def get_or_set(self, key, compute):
+        # Return the cached slice, or compute it and keep it
+        df = self.get(key)
+        if df is not None:
+            return df
+
+        generation = self.generation
+        df = compute()
+        self.put(key, df, generation)
+
+        return handed_out(df)
+
+    def invalidate(self):
+        # Called when the dataset is reloaded
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "generation": self.generation,
+            }
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[2] > self.ttl
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
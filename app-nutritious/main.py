@@ -5,14 +5,17 @@ import pandas as pd
 import requests
 import math
 import numpy as np
-from io import StringIO
 import time
-from collections import Counter 
+
+# Set once for the whole app, before the data is loaded: the slices handed out
+# by the slice cache share their data with it, with copy on write any modification is done on a copy
+pd.set_option('mode.copy_on_write', True)
 
 # Importing the functions
 from functions.dash_figures import create_figure_products, patch_graphic, figure_result_model
-from functions.data_handling import pnns_groups_options, return_df, get_code, df_sorting, get_nutriscore_image
-from functions.data_handling import generate_texte_image, get_texte_product, get_data
+from functions.data_handling import pnns_groups_options, return_df, get_code, get_nutriscore_image
+from functions.data_handling import generate_texte_image, get_texte_product, get_data, get_best_products
+from functions.data_handling import slice_spec, return_sliced_df, get_search_index, search_products, get_product
 from functions.display_images import *
 from functions.language import get_languages_options
 from frontend.navigation_panel import generating_navigating_panel
@@ -145,17 +148,16 @@ def data_slicing(country, pnns1_chosen, pnns2_chosen, _,
         return None
 
     # It follow the same path for all
-    df = return_df(country, pnns1_chosen, pnns2_chosen)
+    ranges = None
     
     if ctx.triggered_id in slider_trigger:
-        for nutrient, slide in zip(["energy_100g"] + nutrients, sliders):
-            df = df[(df[nutrient] >= slide[0]) & (df[nutrient] <= slide[1])]
+        ranges = {nutrient: slide for nutrient, slide in zip(["energy_100g"] + nutrients, sliders)}
     
-    # Transform to json format
-    df = df.to_json(orient='split')
+    # Only the description of the slice is sent, the server rebuilds it or takes it from the cache
+    spec = slice_spec(country, pnns1_chosen, pnns2_chosen, ranges)
     
     print("Data slicing", time.time() - elapsed_time) if DEBUG else None
-    return df
+    return spec
 
     
 @app.callback(
@@ -177,50 +179,39 @@ def search_bar_option_def(country, dropdown_search, search_bar, language, search
     
     if ctx.triggered_id in ['type_search_product', 'dropdown_country'] or search_bar_data is False:
         
-        # If we change pnns or country group, we change the bar_option
-        df = return_df(country, None, None)
+        # If we change the country, we prepare its search index on the server
+        # Only a small state is kept in the store, not the options
+        if country:
+            get_search_index(country, dropdown_search)
         
-        # If we search by product name
-        if dropdown_search == 'product_name':
-            # Get a Series with unique product names and their counts using Counter
-            unique_counts = Counter(df['product_name'])
-
-            # Sort the unique product names
-            sorted_names = sorted(unique_counts.keys())
-
-            # Create the search_bar_option list
-            search_bar_data = [
-                {
-                    'label': f"{name} [{count} {translations[language]['products']}]",
-                    'value': name
-                }
-                for name in sorted_names
-                for count in [unique_counts[name]]
-            ]
-
-        # If we search by product code
-        elif dropdown_search == 'product_code':
-            # Each product has its own unique code
-
-            # Create the search_bar_option list
-            search_bar_data = [
-                {
-                    'label': code,
-                    'value': code
-                }
-                for code in df['code'].unique()
-            ]
-            
+        search_bar_data = {'country': country, 'type_search': dropdown_search}
         search_bar_option = []
     
     # If user has written more than 2 letters or number, we show the selection
     elif ctx.triggered_id == 'search_bar':
         
         if len(search_bar) > 2:
-            # We search for the products
-            search_bar_option = [
-                option for option in search_bar_data
-                if search_bar.lower() in str(option['value']).lower()
+            # We search for the products in the index
+            matches = search_products(country, dropdown_search, search_bar)
+            
+            # If we search by product name
+            if dropdown_search == 'product_name':
+                search_bar_option = [
+                    {
+                        'label': f"{name} [{count} {translations[language]['products']}]",
+                        'value': name
+                    }
+                    for name, count in matches
+                ]
+            
+            # If we search by product code
+            else:
+                search_bar_option = [
+                    {
+                        'label': code,
+                        'value': code
+                    }
+                    for code, _ in matches
                 ]
         else:
             search_bar_option = dash.no_update 
@@ -611,7 +602,7 @@ def display_images(*args):
         df = return_df(country, pnns1_chosen, pnns2_chosen)
         
     elif ctx.triggered_id == 'search_confirmation_button':
-        df = pd.read_json(StringIO(df_slice), orient='split', dtype={'code': str})
+        df = return_sliced_df(df_slice)
         # We adjust if the user has entered a value
         if user_input is not None:
             df = df.query('product_name.str.contains(@user_input)')
@@ -654,8 +645,10 @@ def display_images(*args):
                     
                     title = html.Strong(f"BEST RECOMMENDED PRODUCTS FOR {diets[i].upper()}")
 
-                    # sort and retrieve the N best, then match the nutriscore image           
-                    df_N_best = df_sorting(diets[i], df).head(n_best)
+                    # retrieve the N best, then match the nutriscore image
+                    # The advanced search is sorted, the navigation comes from the ranking index
+                    selection = None if ctx.triggered_id == 'search_confirmation_button' else (country, pnns1_chosen, pnns2_chosen)
+                    df_N_best = get_best_products(diets[i], n_best, df, selection)
                     
                     for y, (_, row) in enumerate(df_N_best.iterrows()):
                         index = y if i == 0 else (20 * i) + y
@@ -693,7 +686,7 @@ def display_images(*args):
         subtitles, images, styles_images, textes_images = generate_texte_image(df, diets, n_best, 
                                                                                subtitles, images, 
                                                                                styles_images, textes_images,
-                                                                               language)
+                                                                               language, (country, pnns1_chosen, pnns2_chosen))
         
         # Replace images by default if something failed in retrieving url
         images = [dash.get_asset_url('no_image.jpg') if url is np.nan else url for url in images]
@@ -731,19 +724,8 @@ def display_images(*args):
                 url = shown_img_data[ctx.triggered_id]
                 code = get_code(url)
 
-            # Some of the codes are writen in int type
-            df_product = get_data().astype({'code': str}).query('code == @code')
-
-            # If failed, we search for in int
-            if df_product.shape[0] == 0:
-                code_int = int(code)
-                df_product = get_data().query('code == @code_int')
-
-            # And another solution it helps to deal with the 0 problem.
-            if df_product.shape[0] == 0:
-                print("Failed to load")
-                code = "0"*(13 - len(code)) + code
-                df_product = get_data().query('code == @code')
+            # The code index handles the codes writen in int type or with the leading 0
+            df_product = get_product(code)
 
             # We get the product's name
             product_name = df_product['product_name'].values[0]
@@ -781,14 +763,14 @@ def display_images(*args):
                 prevent_update, pnns1_chosen, pnns2_chosen = ([dash.no_update]*3)
 
             else:
-                df = return_df(country, pnns1, pnns2).copy()
+                df = return_df(country, pnns1, pnns2)
 
                 title = html.Strong(translations[language]['best_recommended_products'])
 
                 subtitles, images, styles_images, textes_images = generate_texte_image(df, diets, n_best, 
                                                                                        subtitles, images, 
                                                                                        styles_images, textes_images,
-                                                                                       language)
+                                                                                       language, (country, pnns1, pnns2))
                 # Replace images by default if something failed in retrieving url
                 images = [dash.get_asset_url('no_image.jpg') if url is np.nan else url for url in images]
                 
@@ -897,11 +879,11 @@ def modifying_graph(bottom_button, top_button, nutrients_choice_bottom, nutrient
     patched_figure_bottom, patched_figure_top = Patch(), Patch()
 
     if search_on:
-        df = pd.read_json(StringIO(df_slice), orient='split')         
-        df_N_best = df_sorting(dropdown_diet, df).head(n_best)
+        df = return_sliced_df(df_slice)
+        df_N_best = get_best_products(dropdown_diet, n_best, df)
     else:
         df = return_df(country, pnns1_chosen, pnns2_chosen)
-        df_N_best = df_sorting(selected_diet, df).head(n_best)
+        df_N_best = get_best_products(selected_diet, n_best, selection=(country, pnns1_chosen, pnns2_chosen))
 
     if ctx.triggered_id in ["bottom_button_graphic", "dropdown_nutrients_img_bottom", "check_list_graph_img_bottom"]:
         graphic_gestion_style_bottom = {'display':'block'}
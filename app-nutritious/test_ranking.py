@@ -0,0 +1,61 @@
+# run pytest in the folder to test
+
+import numpy as np
+import pandas as pd
+from functions.dataset import prepare_dataset, RANKED_COLUMNS
+from functions.product_store import ProductStore
+from functions.ranking import RankingIndex, TYPE_DIET, top_k
+
+def random_dataset(rng, size):
+    # Few distinct values and missing values, so the sort has ties and NaN to place
+    df = pd.DataFrame({
+        "code": [str(code) for code in rng.integers(1, 10**13, size)],
+        "product_name": [f"product {i}" for i in range(size)],
+        "countries_en": rng.choice(["France", "Germany", "France,Germany", None], size),
+        "pnns_groups_1": rng.choice(["Beverages", "Sugary snacks", None], size),
+        "pnns_groups_2": rng.choice(["Sweets", "Fruit juices", "Biscuits and cakes", None], size),
+    })
+
+    for column in RANKED_COLUMNS:
+        values = rng.integers(-5, 5, size).astype(float)
+        values[rng.random(size) < 0.2] = np.nan
+        df[column] = values
+
+    return prepare_dataset(df)
+
+def reference_best(df, sort_spec, k):
+    # Stable sort of the whole selection, the missing values last
+    return df.sort_values(by=[param['column_id'] for param in sort_spec],
+                          ascending=[param['direction'] for param in sort_spec],
+                          kind="stable", na_position="last").head(k)
+
+def test_top_k_same_as_sort_values():
+
+    rng = np.random.default_rng(0)
+
+    for _ in range(50):
+        df = random_dataset(rng, int(rng.integers(0, 300)))
+
+        # Random specifications: one to three columns, mixed directions
+        columns = rng.choice(RANKED_COLUMNS, int(rng.integers(1, 4)), replace=False)
+        sort_spec = [{'column_id': column, 'direction': bool(rng.integers(2))} for column in columns]
+        k = int(rng.integers(0, 40))
+
+        assert top_k(df, sort_spec, k).index.tolist() == reference_best(df, sort_spec, k).index.tolist()
+
+def test_ranking_index_same_as_sort_values():
+
+    rng = np.random.default_rng(1)
+
+    for _ in range(10):
+        df = random_dataset(rng, int(rng.integers(50, 500)))
+        store = ProductStore(df)
+        ranking_index = RankingIndex(store)
+
+        for country in ["France", "Germany", "Spain"]:
+            for pnns1, pnns2 in [(None, None), ("Beverages", None), ("Sugary snacks", "Sweets")]:
+                selection = store.slice(country, pnns1, pnns2)
+
+                for diet, sort_spec in TYPE_DIET.items():
+                    best = ranking_index.best(country, pnns1, pnns2, diet, 20)
+                    assert best.index.tolist() == reference_best(selection, sort_spec, 20).index.tolist()
@@ -0,0 +1,32 @@
+# run pytest in the folder to test
+
+import numpy as np
+import pandas as pd
+from functions import slice_cache
+from functions.slice_cache import SliceCache
+
+def test_slices_handed_out_dont_change_the_cache():
+
+    cache = SliceCache(max_bytes=10**6)
+    df = pd.DataFrame({"code": ["0042", "3017620422003"], "fat_100g": [1.0, 2.0]})
+
+    # The slice computed, then the one read from the cache, are both modified by the caller
+    first = cache.get_or_set("France", lambda: df)
+    first.loc[0, "fat_100g"] = 10.0
+    second = cache.get_or_set("France", lambda: None)
+    assert second["fat_100g"].tolist() == [1.0, 2.0]
+
+    second.loc[1, "fat_100g"] = 20.0
+    second["code"] = "0"
+    assert cache.get("France").equals(pd.DataFrame({"code": ["0042", "3017620422003"], "fat_100g": [1.0, 2.0]}))
+
+def test_deep_copy_without_copy_on_write(monkeypatch):
+
+    # Without copy on write (pandas 2 without main.py), the slices share no data with the cache
+    monkeypatch.setattr(slice_cache, "copy_on_write", lambda: False)
+
+    cache = SliceCache(max_bytes=10**6)
+    cache.put("France", pd.DataFrame({"fat_100g": [1.0, 2.0]}))
+    cached = cache._entries["France"][0]
+
+    assert not np.shares_memory(cache.get("France")["fat_100g"].to_numpy(), cached["fat_100g"].to_numpy())
@@ -0,0 +1,151 @@
+"""
+Converts the .h5 models of the API to TFLite models (float16, dynamic or int8 quantization),
+checks that they give the same classes as the Keras models and uploads them next to the .h5 files.
+
+    python convert_models.py --quantization float16 int8 --images sample_images/ --upload
+
+The API runs them with INFERENCE_BACKEND=tflite and TFLITE_QUANTIZATION=<quantization>.
+"""
+
+import os
+import glob
+import time
+import argparse
+import logging
+import numpy as np
+import tensorflow as tf
+from functions.loading_api import load_API_models
+from functions.others_functions import get_model_input_size
+from functions.images_functions import decode_image
+from functions.backends import QUANTIZATIONS, TFLiteBackend, tflite_model_path
+from functions.S3_function import upload_file_to_s3
+
+# We import the initials values for loading models and preprocesses
+from config import *
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODELS = {
+    "front": (S3_path_model_front, S3_path_preprocess_front),
+    "pnns1": (S3_path_model_pnns1, S3_path_preprocess_pnns),
+    "pnns2": (S3_path_model_pnns2, S3_path_preprocess_pnns),
+}
+
+# Images by forward pass during the parity check
+PARITY_BATCH_SIZE = 8
+
+def load_samples(images_dir, target_size, samples):
+    """
+    Decoded images used to calibrate the int8 models and to check the parity,
+    random images if no folder is given
+    """
+    if images_dir:
+        paths = sorted(glob.glob(os.path.join(images_dir, "*")))[:samples]
+        images = []
+        for path in paths:
+            try:
+                images.append(decode_image(path, target_size))
+            except Exception as e:
+                logger.warning(f"Can't decode '{path}': {str(e)}")
+        if images:
+            return np.stack(images)
+
+    logger.warning("No sample images, random images are used: the int8 calibration and the parity check are approximate")
+    return np.random.default_rng(0).uniform(0, 255, size=(samples, *target_size, 3)).astype(np.float32)
+
+def convert(keras_model, quantization, calibration_images):
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "float16":
+        # Weights in float16, computations in float32
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == "int8":
+        # Weights and activations in int8, the ranges of the activations come from the calibration images,
+        # the input and output of the model stay in float32
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    # "dynamic": only the weights are in int8
+
+    return converter.convert()
+
+def predict(model, images):
+    # Predictions by batches, and mean time of a batch in ms
+    predictions = []
+    start = time.perf_counter()
+
+    for i in range(0, len(images), PARITY_BATCH_SIZE):
+        predictions.append(np.asarray(model(images[i:i + PARITY_BATCH_SIZE], training=False)))
+
+    batches = -(-len(images) // PARITY_BATCH_SIZE)
+    return np.concatenate(predictions), (time.perf_counter() - start) * 1000 / batches
+
+def parity_check(keras_model, tflite_model, images):
+    """
+    Compare the outputs of the converted model to the Keras model on the same images:
+    share of images with the same class, and largest difference of probability
+    """
+    keras_predictions, keras_latency = predict(keras_model, images)
+    tflite_predictions, tflite_latency = predict(tflite_model, images)
+
+    return {
+        "agreement": float(np.mean(np.argmax(keras_predictions, axis=1) == np.argmax(tflite_predictions, axis=1))),
+        "max_abs_diff": float(np.max(np.abs(keras_predictions - tflite_predictions))),
+        "keras_ms_per_batch": round(keras_latency, 2),
+        "tflite_ms_per_batch": round(tflite_latency, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the .h5 models of the API to quantized TFLite models")
+    parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS))
+    parser.add_argument("--quantization", nargs="+", choices=QUANTIZATIONS, default=["float16"])
+    parser.add_argument("--images", help="Folder of sample images (calibration and parity check)")
+    parser.add_argument("--samples", type=int, default=64, help="Number of sample images")
+    parser.add_argument("--min-agreement", type=float, default=0.98, help="Share of same classes needed to keep a model")
+    parser.add_argument("--output-dir", default="converted_models")
+    parser.add_argument("--upload", action="store_true", help="Upload the models passing the check to S3")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = []
+
+    for name in args.models:
+        model_file, preprocess_file = MODELS[name]
+
+        backend, preprocess_input = load_API_models(model_file, preprocess_file, backend="keras")
+        images = np.asarray(preprocess_input(load_samples(args.images, get_model_input_size(backend), args.samples)), dtype=np.float32)
+
+        for quantization in args.quantization:
+            print(f"[INFO] Converting {name} ({quantization})...")
+
+            object_key = tflite_model_path(model_file, quantization)
+            local_path = os.path.join(args.output_dir, os.path.basename(object_key))
+
+            model_content = convert(backend.model, quantization, images)
+            with open(local_path, "wb") as f:
+                f.write(model_content)
+
+            report = parity_check(backend, TFLiteBackend(model_content), images)
+            print(f"[INFO] {name} ({quantization}): {len(model_content) / 1e6:.1f} MB, {report}")
+
+            if report["agreement"] < args.min_agreement:
+                logger.error(f"{name} ({quantization}): agreement {report['agreement']:.3f} below {args.min_agreement}, not uploaded")
+                failed.append(f"{name} ({quantization})")
+                continue
+
+            if args.upload:
+                upload_file_to_s3(local_path, object_key)
+
+    if failed:
+        raise SystemExit(f"Parity check failed: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
@@ -23,4 +23,17 @@ def download_file_from_s3(object_key, local_file_path):
     
     except Exception as e:
         # Signal if error
-        logger.error(f"Error downloading file '{object_key}': {str(e)}")
\ No newline at end of file
+        logger.error(f"Error downloading file '{object_key}': {str(e)}")
+
+# Function to upload a local file to S3
+def upload_file_to_s3(local_file_path, object_key):
+    s3 = boto3.client('s3')
+
+    try:
+        # Upload local file in the bucket
+        s3.upload_file(local_file_path, bucket_name, object_key)
+        logger.info(f"Uploaded file '{local_file_path}' to '{object_key}'")
+    
+    except Exception as e:
+        # Signal if error
+        logger.error(f"Error uploading file '{local_file_path}': {str(e)}")
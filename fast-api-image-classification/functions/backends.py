@@ -0,0 +1,120 @@
+import os
+import threading
+import logging
+import numpy as np
+import tensorflow as tf
+from functions.batching import BATCH_MAX_SIZE
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Runtime of the models: "keras" (the .h5 models) or "tflite" (the converted models)
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'keras')
+
+# Quantization of the converted models loaded by the tflite backend: float16, dynamic or int8
+TFLITE_QUANTIZATION = os.environ.get('TFLITE_QUANTIZATION', 'float16')
+
+# Threads of a TFLite interpreter
+TFLITE_THREADS = int(os.environ.get('TFLITE_THREADS', os.cpu_count() or 1))
+
+QUANTIZATIONS = ["float16", "dynamic", "int8"]
+
+# Path of the converted model next to the .h5 model, on S3 or on disk
+def tflite_model_path(model_path, quantization=TFLITE_QUANTIZATION):
+    return f"{os.path.splitext(model_path)[0]}_{quantization}.tflite"
+
+
+class KerasBackend:
+    """
+        The .h5 model loaded by Keras, run in graph mode
+    """
+
+    name = "keras"
+
+    def __init__(self, model):
+        self.model = model
+        self.input_size = tuple(model.input_shape[1:3])
+
+    def __call__(self, images, training=False):
+        return self.model(images, training=False).numpy()
+
+
+class TFLiteBackend:
+    """
+        A model converted by convert_models.py, run by the TFLite interpreter.
+        One interpreter is allocated once for each of batch_sizes: a batch is padded
+        to the smallest of them that holds it (the single images keep an interpreter of 1),
+        and a larger batch is run by parts, so the tensors are never resized between calls.
+        Quantized inputs / outputs are converted from / to float.
+        One interpreter can't run two batches at the same time, its calls are locked.
+    """
+
+    name = "tflite"
+
+    def __init__(self, model_content, num_threads=TFLITE_THREADS, batch_sizes=(1, BATCH_MAX_SIZE)):
+        self.batch_sizes = sorted(set(batch_sizes))
+        self._interpreters = {}
+
+        for batch_size in self.batch_sizes:
+            interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(input_details["index"], [batch_size] + list(input_details["shape"][1:]))
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = (interpreter, threading.Lock())
+
+        interpreter, _ = self._interpreters[self.batch_sizes[0]]
+        self._input = interpreter.get_input_details()[0]
+        self._output = interpreter.get_output_details()[0]
+        self.input_size = tuple(int(size) for size in self._input["shape"][1:3])
+
+    def __call__(self, images, training=False):
+        images = np.asarray(images, dtype=np.float32)
+        max_batch_size = self.batch_sizes[-1]
+
+        if len(images) > max_batch_size:
+            return np.concatenate([self(images[start:start + max_batch_size])
+                                   for start in range(0, len(images), max_batch_size)])
+
+        batch_size = min(size for size in self.batch_sizes if size >= len(images))
+        padded_images = images
+        if batch_size > len(images):
+            # The rows of the padding are computed then dropped, the interpreter keeps its size
+            padding = np.zeros((batch_size - len(images),) + images.shape[1:], dtype=np.float32)
+            padded_images = np.concatenate([images, padding])
+
+        interpreter, lock = self._interpreters[batch_size]
+        with lock:
+            interpreter.set_tensor(self._input["index"], self._quantize(padded_images))
+            interpreter.invoke()
+            predictions = interpreter.get_tensor(self._output["index"])
+
+        return self._dequantize(predictions[:len(images)])
+
+    def _quantize(self, images):
+        if self._input["dtype"] == np.float32:
+            return images
+
+        scale, zero_point = self._input["quantization"]
+        info = np.iinfo(self._input["dtype"])
+        return np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(self._input["dtype"])
+
+    def _dequantize(self, predictions):
+        if self._output["dtype"] == np.float32:
+            return predictions
+
+        scale, zero_point = self._output["quantization"]
+        return (predictions.astype(np.float32) - zero_point) * scale
+
+
+# Load a model file with the backend
+def load_backend(path, backend=INFERENCE_BACKEND):
+    if not os.path.exists(path):
+        logger.warning(f"No file present at '{path}'")
+        return None
+
+    if backend == "tflite":
+        with open(path, "rb") as f:
+            return TFLiteBackend(f.read())
+
+    return KerasBackend(tf.keras.models.load_model(path))
@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Images by forward pass, and time waited for other requests before running a batch
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 8))
+BATCH_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT_MS', 10)) / 1000
+
+
+class MicroBatcher:
+    """
+        Groups the images of concurrent requests on the same model:
+        the requests put their decoded image in a queue, a worker takes up to
+        max_batch_size images (waiting at most max_wait after the first one),
+        runs one forward pass with predict_batch and gives each request its row.
+        The forward pass runs in the threads of executor (the default executor of the loop if None).
+    """
+
+    def __init__(self, name, predict_batch, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT, executor=None):
+        self.name = name
+        self.predict_batch = predict_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    def _start(self):
+        # The queue and the worker belong to the event loop of the app
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def predict(self, image):
+        """
+            Prediction of one decoded image (H, W, 3), the row of the batch it was part of
+        """
+        self._start()
+
+        future = self._loop.create_future()
+        await self._queue.put((image, future))
+        self.requests += 1
+
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            # Other requests arriving during max_wait join the batch
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # The requests cancelled while waiting are not computed
+            batch = [(image, future) for image, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+
+            try:
+                # The forward pass runs in a thread, the event loop keeps answering
+                predictions = await self._loop.run_in_executor(self.executor, self.predict_batch, [image for image, _ in batch])
+            except Exception as e:
+                logger.warning(f"status: error predicting batch on {self.name}")
+                logger.warning(f"message: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": round(sum(size * count for size, count in self.batch_sizes.items()) / self.batches, 2) if self.batches else None,
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
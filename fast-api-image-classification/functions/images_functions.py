@@ -1,75 +1,80 @@
 from PIL import Image
+import numpy as np
 import tensorflow as tf
-import gc
-from functions.others_functions import argmax
-
-def load_and_preprocess_image(image_path, preprocess_input, target_size):
-    # Load and preprocess a single image
-    with tf.keras.preprocessing.image.load_img(image_path, target_size=target_size) as img:
-        img_array = tf.keras.preprocessing.image.img_to_array(img)
-        img_array = tf.expand_dims(img_array, 0)  # Create batch dimension
-        
-        # We return the image after preprocessing
-        return preprocess_input(img_array)
-
-def predict_on_image(image_path, model, preprocess_input, target_size):
-    preprocessed_image = load_and_preprocess_image(image_path, preprocess_input, target_size)
-    
-    try:
-        predictions = model(preprocessed_image)
-    except: 
-        predictions = model.predict(preprocessed_image)
-
-    gc.collect()
-
-    return predictions
-
-def process_image(image_content, model, preprocess_input, target_size):
-    # Predict on the image, used for the front classification
-
-    result_prediction = str(argmax(predict_on_image(image_content, model, preprocess_input, target_size)))
-
-    gc.collect()
-    
-    # Return a dictionary or any other data you want
-    return {"status": "success", "result": result_prediction}
-
-def img_prediction_model_pnns(image_content, pnns_groups, model, preprocess_input, target_size):
-    # Predict pnns group
-
-    if pnns_groups == "pnns_groups_1":
-        list_pnns = ['Composite foods', 'Fruits and vegetables', 'Cereals and potatoes', 'Fat and sauces',
-                    'Salty snacks', 'Beverages', 'Sugary snacks', 'Fish Meat Eggs', 'Milk and dairy products']
-    
-    elif pnns_groups == "pnns_groups_2":
-        list_pnns = ['Pizza pies and quiches', 'Fruits', 'Bread', 'Dressings and sauces', 'Salty and fatty products',
-                     'Sweetened beverages', 'Sweets', 'Biscuits and cakes', 'Pastries', 'Fish and seafood',
-                     'One-dish meals', 'Appetizers', 'Cheese', 'Fats', 'Processed meat', 'Sandwiches',
-                     'Vegetables', 'Breakfast cereals', 'Chocolate products', 'Unsweetened beverages',
-                     'Dried fruits', 'Meat', 'Cereals', 'Eggs', 'Plant-based milk substitutes', 'Legumes',
-                     'Teas and herbal teas and coffees', 'Dairy desserts', 'Nuts', 'Fruit juices',
-                     'Milk and yogurt', 'Artificially sweetened beverages', 'Potatoes', 'Soups', 'Ice cream',
-                     'Offals', 'Waters and flavored waters', 'Fruit nectars']
-
-    result = predict_on_image(image_content, model, preprocess_input, target_size)
-    
-    image_proba = []
-    
-    for pnns, proba in zip(list_pnns, result[0]):
-        image_proba.append([pnns, proba])
-        
-    # Using a list of dictionaries
-    result = tf.unstack(result)[0].numpy().tolist() if isinstance(result, tf.Tensor) else result.tolist()
-    
-    #image_proba = list(zip(list_pnns, result[0].tolist()))
-    image_proba = list(zip(list_pnns, result))
+import logging
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def decode_image(image_content, target_size):
+    # Decode and resize an image, without batch dimension and preprocessing
+    with tf.keras.preprocessing.image.load_img(image_content, target_size=target_size) as img:
+        return tf.keras.preprocessing.image.img_to_array(img)
+
+def predict_on_batch(images, model, preprocess_input):
+    """
+    Predict on several decoded images at once: they are stacked in one
+    (N, H, W, 3) tensor, preprocessed once and sent to the model in one call
+    """
+    preprocessed_images = preprocess_input(np.stack(images))
+
+    # The backends (and the Keras models) are called directly, their errors are raised
+    predictions = model(preprocessed_images, training=False)
+
+    # A multi-head model gives the predictions of each head
+    if isinstance(predictions, (list, tuple)):
+        return [np.asarray(head_predictions) for head_predictions in predictions]
+
+    return predictions.numpy() if isinstance(predictions, tf.Tensor) else np.asarray(predictions)
+
+def process_images_batch(image_contents, model, preprocess_input, target_size):
+    """
+    Front classification of a batch of images with one model call
+    Return one result by image, "None" for the images that can't be decoded
+    """
+    results = ["None"] * len(image_contents)
+    decoded_images = []
+    decoded_positions = []
+
+    for i, image_content in enumerate(image_contents):
+        if image_content is None:
+            continue
+
+        try:
+            decoded_images.append(decode_image(image_content, target_size))
+            decoded_positions.append(i)
+        except Exception as e:
+            logger.warning("status: error decoding image in batch")
+            logger.warning(f"message: {str(e)}")
+
+    if decoded_images:
+        predictions = predict_on_batch(decoded_images, model, preprocess_input)
+
+        for i, prediction in zip(decoded_positions, np.argmax(predictions, axis=1)):
+            results[i] = {"status": "success", "result": str(prediction)}
+
+    return results
+
+# Names of the pnns groups, in the order of the outputs of the models
+LIST_PNNS = {
+    "pnns_groups_1": ['Composite foods', 'Fruits and vegetables', 'Cereals and potatoes', 'Fat and sauces',
+                      'Salty snacks', 'Beverages', 'Sugary snacks', 'Fish Meat Eggs', 'Milk and dairy products'],
+    "pnns_groups_2": ['Pizza pies and quiches', 'Fruits', 'Bread', 'Dressings and sauces', 'Salty and fatty products',
+                      'Sweetened beverages', 'Sweets', 'Biscuits and cakes', 'Pastries', 'Fish and seafood',
+                      'One-dish meals', 'Appetizers', 'Cheese', 'Fats', 'Processed meat', 'Sandwiches',
+                      'Vegetables', 'Breakfast cereals', 'Chocolate products', 'Unsweetened beverages',
+                      'Dried fruits', 'Meat', 'Cereals', 'Eggs', 'Plant-based milk substitutes', 'Legumes',
+                      'Teas and herbal teas and coffees', 'Dairy desserts', 'Nuts', 'Fruit juices',
+                      'Milk and yogurt', 'Artificially sweetened beverages', 'Potatoes', 'Soups', 'Ice cream',
+                      'Offals', 'Waters and flavored waters', 'Fruit nectars'],
+}
+
+def pnns_probabilities(pnns_groups, prediction):
+    # Probabilities of one image (a row of predictions), sorted from the most probable group
+    image_proba = list(zip(LIST_PNNS[pnns_groups], np.asarray(prediction).tolist()))
 
     image_proba.sort(key=lambda x: x[1], reverse=True)
 
     # Convert the sorted list of tuples to a list of dictionaries
-    image_proba = [{"pnns_groups": pnns, "probabilities": proba} for pnns, proba in image_proba]
-    
-    del result
-    gc.collect()
-
-    return image_proba
\ No newline at end of file
+    return [{"pnns_groups": pnns, "probabilities": proba} for pnns, proba in image_proba]
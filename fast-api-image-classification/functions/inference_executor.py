@@ -0,0 +1,82 @@
+import os
+import asyncio
+import logging
+import contextlib
+import concurrent.futures
+import tensorflow as tf
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Threads decoding the images and running the models
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 2))
+
+# Requests accepted at the same time (running or waiting), above it the API answers 503
+INFERENCE_MAX_PENDING = int(os.environ.get('INFERENCE_MAX_PENDING', 64))
+
+# Seconds the client is asked to wait before trying again
+INFERENCE_RETRY_AFTER = int(os.environ.get('INFERENCE_RETRY_AFTER', 1))
+
+def configure_threading():
+    """
+    Threads used by TensorFlow inside an operation (intra) and between
+    independent operations (inter), 0 lets TensorFlow decide.
+    Must be called before the models are loaded.
+    """
+    intra_op_threads = int(os.environ.get('TF_INTRA_OP_THREADS', 0))
+    inter_op_threads = int(os.environ.get('TF_INTER_OP_THREADS', 0))
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        logger.info(f"TensorFlow threads: intra-op {intra_op_threads}, inter-op {inter_op_threads}")
+    except RuntimeError as e:
+        # TensorFlow was already initialized
+        logger.warning(f"TensorFlow threads can't be set: {str(e)}")
+
+
+class InferenceOverloaded(Exception):
+    """
+        Raised when too many requests are waiting for the models
+    """
+
+    def __init__(self, retry_after=INFERENCE_RETRY_AFTER):
+        super().__init__("Too many inference requests, retry later.")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+        Pool of threads running the decoding of the images and the models,
+        so the event loop only handles the requests.
+        A request takes a slot for its whole inference, when the max_pending
+        slots are taken the request is refused at once (InferenceOverloaded)
+        instead of waiting in an unbounded queue.
+    """
+
+    def __init__(self, max_workers=INFERENCE_WORKERS, max_pending=INFERENCE_MAX_PENDING):
+        self.max_pending = max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+
+        self.pending = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        # The requests are counted in the event loop, no lock is needed
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise InferenceOverloaded()
+
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def stats(self):
+        return {"pending": self.pending, "max_pending": self.max_pending, "rejected": self.rejected}
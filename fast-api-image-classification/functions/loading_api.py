@@ -4,6 +4,7 @@ import os
 import gc
 import logging
 from functions.S3_function import download_file_from_s3
+from functions.backends import INFERENCE_BACKEND, load_backend, tflite_model_path
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -38,10 +39,18 @@ def remove_local_file(file_path):
     except Exception as e:
         logger.error(f"Error removing file '{file_path}': {str(e)}")
 
-def load_API_models(model_file, preprocess_file):
+def load_API_models(model_file, preprocess_file, backend=INFERENCE_BACKEND):
+    """
+    Return the model run by the backend ("keras" or "tflite") and its preprocess,
+    the tflite backend loads the model converted from model_file by convert_models.py
+    """
 
     # Local file paths to save the downloaded files
-    local_model_path = 'local_model_front_back.h5'
+    if backend == "tflite":
+        model_file = tflite_model_path(model_file)
+        local_model_path = 'local_model_front_back.tflite'
+    else:
+        local_model_path = 'local_model_front_back.h5'
     local_preprocess_path = 'local_preprocess_input.pkl'
 
     print("[INFO] Downloading files...")
@@ -50,10 +59,10 @@ def load_API_models(model_file, preprocess_file):
     download_file_from_s3(model_file, local_model_path)
     download_file_from_s3(preprocess_file, local_preprocess_path)
 
-    print("[INFO] Loading files...")
+    print(f"[INFO] Loading files ({backend})...")
 
     # We load the models and preprocess
-    loaded_model = load_model(local_model_path)
+    loaded_model = load_backend(local_model_path, backend)
     loaded_preprocess_input = load_preprocess(local_preprocess_path)
 
     print("[INFO] Deleting files...")
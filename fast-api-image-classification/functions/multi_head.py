@@ -0,0 +1,122 @@
+import os
+import logging
+import numpy as np
+import tensorflow as tf
+from functions.backends import KerasBackend
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Run the pnns models with one backbone when they share it
+SHARED_BACKBONE = os.environ.get('SHARED_BACKBONE', '1') == '1'
+
+# Images used to check that the shared model gives the outputs of the separate models
+CHECK_IMAGES = 2
+
+def split_backbone(model):
+    """
+    Split a transfer learning model in the layers up to its pretrained backbone
+    (the nested Keras model) and the layers of the classification head after it
+    """
+    layers = [layer for layer in model.layers if not isinstance(layer, tf.keras.layers.InputLayer)]
+
+    for i, layer in enumerate(layers):
+        if isinstance(layer, tf.keras.Model):
+            return layers[:i + 1], layers[i + 1:]
+
+    return None
+
+def same_backbone(backbone_layers_1, backbone_layers_2):
+    # Same layers with the same weights, the backbone wasn't fine-tuned differently
+    if len(backbone_layers_1) != len(backbone_layers_2):
+        return False
+
+    for layer_1, layer_2 in zip(backbone_layers_1, backbone_layers_2):
+        weights_1, weights_2 = layer_1.get_weights(), layer_2.get_weights()
+        if type(layer_1) is not type(layer_2) or len(weights_1) != len(weights_2):
+            return False
+        if not all(w1.shape == w2.shape and np.array_equal(w1, w2) for w1, w2 in zip(weights_1, weights_2)):
+            return False
+
+    return True
+
+def clone_layer(layer):
+    """
+    New layer with the config of layer, without its weights (set once it is built).
+    The layers of a loaded model keep their inbound nodes, which reference the graph
+    of the model: the shared model uses copies so the separate models can be freed
+    """
+    if isinstance(layer, tf.keras.Model):
+        return tf.keras.models.clone_model(layer)
+
+    return layer.__class__.from_config(layer.get_config())
+
+def apply_layers(layers, x):
+    for layer in layers:
+        x = layer(x, training=False)
+    return x
+
+
+class MultiHeadBackend:
+    """
+        One Keras model computing the backbone features of the images once
+        and giving them to the classification head of each model.
+        A call returns the predictions of each head, in the order of the models.
+    """
+
+    name = "multi_head"
+
+    def __init__(self, model, input_size):
+        self.model = model
+        self.input_size = input_size
+
+    def __call__(self, images, training=False):
+        return [predictions.numpy() for predictions in self.model(images, training=False)]
+
+
+def build_multi_head(backends):
+    """
+    Shared backbone model of Keras backends, None when the models don't share their backbone
+    (different backbone weights, other architecture or runtime): they are then run separately
+    """
+    if not all(isinstance(backend, KerasBackend) for backend in backends):
+        logger.info("Shared backbone only available with the keras backend")
+        return None
+
+    try:
+        splits = [split_backbone(backend.model) for backend in backends]
+        if any(split is None for split in splits):
+            logger.info("No pretrained backbone found in the models")
+            return None
+
+        backbone_layers = splits[0][0]
+        if not all(same_backbone(backbone_layers, split[0]) for split in splits[1:]):
+            logger.info("The models have different backbone weights, they can't share it")
+            return None
+
+        # The shared model is built with copies of the layers, the weights are copied once they are built
+        layers = backbone_layers + [layer for _, head_layers in splits for layer in head_layers]
+        clones = {id(layer): clone_layer(layer) for layer in layers}
+
+        inputs = tf.keras.Input(shape=backends[0].model.input_shape[1:])
+        features = apply_layers([clones[id(layer)] for layer in backbone_layers], inputs)
+        model = tf.keras.Model(inputs, [apply_layers([clones[id(layer)] for layer in head_layers], features)
+                                        for _, head_layers in splits])
+
+        for layer in layers:
+            clones[id(layer)].set_weights(layer.get_weights())
+
+        # The shared model has to give the outputs of the separate models
+        images = np.random.default_rng(0).uniform(-1, 1, size=(CHECK_IMAGES, *inputs.shape[1:])).astype(np.float32)
+        for backend, predictions in zip(backends, model(images, training=False)):
+            if not np.allclose(backend(images), predictions.numpy(), atol=1e-4):
+                logger.warning("The shared backbone model doesn't give the outputs of the separate models")
+                return None
+
+    except Exception as e:
+        logger.warning(f"The shared backbone model can't be built: {str(e)}")
+        return None
+
+    logger.info(f"Backbone shared by {len(backends)} heads")
+    return MultiHeadBackend(model, backends[0].input_size)
@@ -5,7 +5,12 @@ from io import BytesIO
 import base64
 from functions.loading_api import load_API_models
 from functions.others_functions import get_model_input_size
-from functions.images_functions import process_image, img_prediction_model_pnns
+from functions.images_functions import process_images_batch, decode_image, predict_on_batch, pnns_probabilities
+from functions.batching import MicroBatcher
+from functions.inference_executor import InferenceExecutor, InferenceOverloaded, configure_threading
+from functions.multi_head import SHARED_BACKBONE, build_multi_head
+import numpy as np
+import asyncio
 import gc
 import logging
 
@@ -18,6 +23,9 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# TensorFlow threads are set before the models are loaded
+configure_threading()
+
 # We load the models and the preprocesses
 loaded_model_front, loaded_preprocess_input_front = load_API_models(S3_path_model_front, S3_path_preprocess_front)
 target_size_front = get_model_input_size(loaded_model_front)
@@ -25,6 +33,75 @@ loaded_model_pnns1, loaded_preprocess_input_pnns = load_API_models(S3_path_model
 target_size_pnns = get_model_input_size(loaded_model_pnns1)
 loaded_model_pnns2, _ = load_API_models(S3_path_model_pnns2, S3_path_preprocess_pnns)
 
+# The decoding and the models run in a bounded pool of threads, out of the event loop
+inference_executor = InferenceExecutor()
+
+# The single image requests on the same model are grouped in batches
+front_batcher = MicroBatcher("front", lambda images: predict_on_batch(images, loaded_model_front, loaded_preprocess_input_front), executor=inference_executor.executor)
+
+# The two pnns models run with one backbone when they share it: one forward pass gives both levels,
+# the pnns_groups_1 and pnns_groups_2 requests are batched together
+PNNS_GROUPS = ["pnns_groups_1", "pnns_groups_2"]
+loaded_model_pnns = build_multi_head([loaded_model_pnns1, loaded_model_pnns2]) if SHARED_BACKBONE else None
+
+if loaded_model_pnns is not None:
+    # The shared model only holds copies of the layers, the separate models (and their second backbone) are freed
+    del loaded_model_pnns1, loaded_model_pnns2
+    gc.collect()
+
+    pnns_batcher = MicroBatcher("pnns_groups", lambda images: list(zip(*predict_on_batch(images, loaded_model_pnns, loaded_preprocess_input_pnns))), executor=inference_executor.executor)
+    batchers = [front_batcher, pnns_batcher]
+else:
+    pnns1_batcher = MicroBatcher("pnns_groups_1", lambda images: predict_on_batch(images, loaded_model_pnns1, loaded_preprocess_input_pnns), executor=inference_executor.executor)
+    pnns2_batcher = MicroBatcher("pnns_groups_2", lambda images: predict_on_batch(images, loaded_model_pnns2, loaded_preprocess_input_pnns), executor=inference_executor.executor)
+    pnns_batchers = {"pnns_groups_1": pnns1_batcher, "pnns_groups_2": pnns2_batcher}
+    batchers = [front_batcher, pnns1_batcher, pnns2_batcher]
+
+async def predict_pnns(image, pnns_groups_list):
+    # Prediction of the image for each pnns level asked
+    if loaded_model_pnns is not None:
+        predictions = await pnns_batcher.predict(image)
+        return [predictions[PNNS_GROUPS.index(pnns_groups)] for pnns_groups in pnns_groups_list]
+
+    return await asyncio.gather(*[pnns_batchers[pnns_groups].predict(image) for pnns_groups in pnns_groups_list])
+
+def overloaded_response(e):
+    # Too many requests waiting for the models, the client retries later
+    logger.warning(f"status: {str(e)}")
+    return JSONResponse(status_code=503, content={"status": "error", "message": str(e)},
+                        headers={"Retry-After": str(e.retry_after)})
+
+async def read_image_contents(file, base64_image):
+    # Content of the image sent as a file or as a base64 string
+    if file:
+    # If file image is provided, decode it
+        
+        logger.info("A file was uploaded")
+
+        # Uploaded file as to be one of those extension
+        if file.content_type not in ["image/png", "image/jpeg", "image/jpg"]:
+            raise ValueError("Only PNG, JPEG or JPG images are allowed.")
+
+        # Read the file content
+        return await file.read()
+
+    elif base64_image:
+    # If base64 image is provided, we decode it
+        
+        logger.info("A base64 image was uploaded")
+
+        if 'base64,' in base64_image:
+            data_split = base64_image.split('base64,')
+        
+            encoded_data = data_split[1]
+        
+            return base64.b64decode(encoded_data)
+
+        else: 
+            return base64.b64decode(base64_image)
+
+    raise ValueError("No image provided.")
+
 @app.get("/")
 def home():
     return {"health_check": "OK"}
@@ -40,17 +117,21 @@ async def process_image_endpoint(file: UploadFile = File(...)):
         # Read the file content
         file_contents = await file.read()
 
-        # Process the image
+        # Process the image, the prediction is done in a batch with the concurrent requests
         try:
-            result = process_image(BytesIO(file_contents), loaded_model_front, loaded_preprocess_input_front, target_size_front)
-            
+            async with inference_executor.slot():
+                image = await inference_executor.run(decode_image, BytesIO(file_contents), target_size_front)
+                prediction = await front_batcher.predict(image)
+            result = {"status": "success", "result": str(int(np.argmax(prediction)))}
+
+        except InferenceOverloaded as e:
+            return overloaded_response(e)
+
         except Exception as e:
             logger.warning("status: error processing image")
             logger.warning(f"message: {str(e)}")
             result = "None"
 
-        gc.collect()
-
         return JSONResponse(content=result)
     except Exception as e:
         logger.warning("status: error processing single image")
@@ -65,30 +146,25 @@ async def process_batch_images_endpoint(files: List[UploadFile] = File(...)):
         if not files:
             raise ValueError("No files provided.")
 
-        # Process each image in the batch
-        results = []
+        # Read the contents, the files with a wrong type get "None" without failing the batch
+        image_contents = []
         for file in files:
             if file.content_type not in ["image/png", "image/jpeg", "image/jpg"]:
-                raise ValueError(f"Only PNG, JPEG, or JPG images are allowed. File: {file.filename}")
-
-            # Read the file content
-            file_contents = await file.read()
-
-            # Process the image
-            try:
-                result = process_image(BytesIO(file_contents), loaded_model_front, loaded_preprocess_input_front, target_size_front)
-
-            except Exception as e:
-                logger.warning("status: error processing image in batch")
-                logger.warning(f"message: {str(e)}")
-                result = "None"
-
-            results.append(result)
+                logger.warning(f"Only PNG, JPEG, or JPG images are allowed. File: {file.filename}")
+                image_contents.append(None)
+            else:
+                image_contents.append(BytesIO(await file.read()))
+
+        # All the images are classified with one call of the model
+        async with inference_executor.slot():
+            results = await inference_executor.run(process_images_batch, image_contents, loaded_model_front, loaded_preprocess_input_front, target_size_front)
         
         # Clear memory (optional)
         gc.collect()
 
         return JSONResponse(content=results)
+    except InferenceOverloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logger.warning("status: error during processing batch")
         logger.warning(f"message: {str(e)}")
@@ -103,53 +179,70 @@ async def process_image_endpoint(
     logger.info("API was called...")
 
     try:
-        if file:
-        # If file image is provided, decode it
-            
-            logger.info("A file was uploaded")
-
-            # Uploaded file as to be one of those extension
-            if file.content_type not in ["image/png", "image/jpeg", "image/jpg"]:
-                raise ValueError("Only PNG, JPEG or JPG images are allowed.")
-
-            # Read the file content
-            file_contents = await file.read()
-
-
-        elif base64_image:
-        # If base64 image is provided, we decode it
-            
-            logger.info("A base64 image was uploaded")
-
-            if 'base64,' in base64_image:
-                data_split = base64_image.split('base64,')
-            
-                encoded_data = data_split[1]
-            
-                file_contents = base64.b64decode(encoded_data)
-
-            else: 
-                file_contents = base64.b64decode(base64_image)
+        file_contents = await read_image_contents(file, base64_image)
 
         # We do the prediction on 
             
         logger.info(f"The prediction is done on {pnns_groups}")
         
-        if pnns_groups == "pnns_groups_2":
-            result = img_prediction_model_pnns(BytesIO(file_contents), pnns_groups, loaded_model_pnns2, loaded_preprocess_input_pnns, target_size_pnns)
-        else:
+        if pnns_groups != "pnns_groups_2":
             # Default condition, if pnns_groups == None or pnns_groups_1
             pnns_groups = "pnns_groups_1"
-            result = img_prediction_model_pnns(BytesIO(file_contents), pnns_groups, loaded_model_pnns1, loaded_preprocess_input_pnns, target_size_pnns)
-        gc.collect()
+
+        async with inference_executor.slot():
+            image = await inference_executor.run(decode_image, BytesIO(file_contents), target_size_pnns)
+            prediction, = await predict_pnns(image, [pnns_groups])
+
+        result = pnns_probabilities(pnns_groups, prediction)
+        
+        logger.info("...successful prediction")
+
+        return JSONResponse(content=result)
+
+    except InferenceOverloaded as e:
+        return overloaded_response(e)
+
+    except Exception as e:
         
+        logger.info("status: error")
+        logger.info(f"message: {str(e)}")
+
+        return JSONResponse(content={"status": "error", "message": str(e)})
+
+@app.post("/pnns-process-image-all-groups/")
+async def process_image_all_groups_endpoint(
+    file: UploadFile = File(None), 
+    base64_image: str = Form(None)):
+
+    logger.info("API was called on all the pnns groups...")
+
+    try:
+        file_contents = await read_image_contents(file, base64_image)
+
+        # Both levels come from the same forward pass when the backbone is shared
+        async with inference_executor.slot():
+            image = await inference_executor.run(decode_image, BytesIO(file_contents), target_size_pnns)
+            predictions = await predict_pnns(image, PNNS_GROUPS)
+
+        result = {pnns_groups: pnns_probabilities(pnns_groups, prediction) for pnns_groups, prediction in zip(PNNS_GROUPS, predictions)}
+
         logger.info("...successful prediction")
 
         return JSONResponse(content=result)
 
+    except InferenceOverloaded as e:
+        return overloaded_response(e)
+
     except Exception as e:
         
         logger.info("status: error")
         logger.info(f"message: {str(e)}")
 
         return JSONResponse(content={"status": "error", "message": str(e)})
+
+@app.get("/inference-stats/")
+def inference_stats():
+    # Queue depth and sizes of the batches run on each model, and the requests admitted / refused
+    stats = {batcher.name: batcher.stats() for batcher in batchers}
+    stats["executor"] = inference_executor.stats()
+    return stats
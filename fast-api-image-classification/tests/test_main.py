@@ -36,6 +36,28 @@ def test_front_process_image():
     assert response_failed.json() == "None"
     assert response_succeeded.json()['result'] in ['0', '1']
 
+def test_front_process_batch_images():
+
+    # Two links to try out
+    url_failed = "https://images.openfoodfacts.org/images/products/1281/1.400.jpg"
+    
+    url_succeeded = "https://images.openfoodfacts.org/images/products/1885/1.400.jpg"
+    
+    content_failed = requests.get(url_failed).content
+    content_succeeded = requests.get(url_succeeded).content
+
+    # The image that can't be decoded doesn't fail the batch
+    files = [("files", ('temp_image.jpg', content, 'image/jpg')) for content in [content_succeeded, content_failed, content_succeeded]]
+
+    response = client.post("/front-process-batch-images/", files = files)
+
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+
+    assert response.json()[1] == "None"
+    assert response.json()[0]['result'] in ['0', '1']
+    assert response.json()[0] == response.json()[2]
+
 def test_pnns_process_image_files():
 
     # Two links to try out
@@ -87,3 +109,22 @@ def test_pnns_process_image_b64():
 
     assert isinstance(response_succeeded.json(), list)
     assert 'pnns_groups' in response_succeeded.json()[0]
+
+
+def test_pnns_process_image_all_groups():
+
+    url_succeeded = "https://images.openfoodfacts.org/images/products/1885/1.400.jpg"
+    
+    content_succeeded = requests.get(url_succeeded).content
+
+    files_succeeded = {"file": ('temp_image.jpg', content_succeeded, 'image/jpg')}
+
+    response = client.post("/pnns-process-image-all-groups/", files = files_succeeded)
+    response_pnns2 = client.post("/pnns-process-image/", files = files_succeeded, data = {"pnns_groups": "pnns_groups_2"})
+
+    assert response.status_code == 200
+
+    # Both levels are returned, the same as with the endpoint of one level
+    assert len(response.json()['pnns_groups_1']) == 9
+    assert len(response.json()['pnns_groups_2']) == 38
+    assert response.json()['pnns_groups_2'][0]['pnns_groups'] == response_pnns2.json()[0]['pnns_groups']